@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+
+from ptouch.label import Label, cache_clear
+from ptouch.ptd600 import tape_sizes
+from ptouch.sim import open_sim
+
+titles = {
+    "short": "Box",
+    "long": "Network Switch Rack 3 Shelf B",
+}
+subtitles = {
+    "none": "",
+    "short": "Spare Cables",
+}
+ids = {
+    "none": "",
+    "id": "00042",
+}
+qrs = {
+    "none": "",
+    "short": "https://znnxs.com/item/00042",
+    "long": "https://znnxs.com/item/00042?location=rack-3-shelf-b&owner=infrastructure&tag=spare",
+}
+
+stages = ["title", "qr", "render", "rasterize", "encode", "transmit"]
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# startup budgets in ms, best of --repeat runs of a fresh interpreter
+startup_budgets = {
+    "help": 100,
+    "preview": 250,
+    "preview_qr": 300,
+    "print": 350,
+}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return ret, time.perf_counter() - start
+
+
+def bench_case(ptouch, title, subtitle, id, qr, repeat):
+    times = {stage: 0.0 for stage in stages}
+    sent = 0
+    for _ in range(repeat):
+        # every stage renders from scratch, not from the font, text and QR caches
+        cache_clear()
+        label = Label(title, subtitle, id, qr, height=ptouch.tape_px)
+        _, t = timed(label.title_img)
+        times["title"] += t
+        if qr:
+            _, t = timed(label.qr_img)
+            times["qr"] += t
+        # a fresh label with cold caches, so render includes the title and QR code again
+        cache_clear()
+        label = Label(title, subtitle, id, qr, height=ptouch.tape_px)
+        img, t = timed(label.render)
+        times["render"] += t
+        _, t = timed(ptouch.make_raster, img)
+        times["rasterize"] += t
+        (job, stats), t = timed(ptouch.build_job, img)
+        times["encode"] += t
+        _, t = timed(ptouch.send, job)
+        times["transmit"] += t
+        sent += len(job)
+
+    result = {stage: times[stage] / repeat * 1000 for stage in stages}
+    # title and qr are timed separately, render includes them again
+    total = times["render"] + times["encode"] + times["transmit"]
+    result["labels_per_sec"] = repeat / total if total else 0
+    result["bytes"] = sent // repeat
+    return result
+
+
+def run(widths, repeat):
+    results = {}
+    for width in widths:
+        with open_sim(width) as ptouch:
+            for (tk, title), (sk, subtitle), (ik, id), (qk, qr) in itertools.product(
+                    titles.items(), subtitles.items(), ids.items(), qrs.items()):
+                name = f"{width}mm/title-{tk}/subtitle-{sk}/id-{ik}/qr-{qk}"
+                try:
+                    results[name] = bench_case(ptouch, title, subtitle, id, qr, repeat)
+                except ValueError as e:
+                    # e.g. a long QR code does not fit on narrow tape
+                    print("%-60s skipped: %s" % (name, e))
+                    continue
+                print("%-60s %7.1f labels/s %6d bytes" % (name, results[name]["labels_per_sec"], results[name]["bytes"]))
+
+    summary = {stage: sum(r[stage] for r in results.values()) / len(results) for stage in stages}
+    summary["labels_per_sec"] = sum(r["labels_per_sec"] for r in results.values()) / len(results)
+    summary["bytes"] = sum(r["bytes"] for r in results.values())
+    return results, summary
+
+
+def run_startup(repeat):
+    script = os.path.join(ROOT, "print_label.py")
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "preview.png")
+        cases = {
+            "help": [sys.executable, script, "--help"],
+            "preview": [sys.executable, script, "Test", "-o", out],
+            "preview_qr": [sys.executable, script, "Test", "https://znnxs.com/item/00042", "-o", out],
+            # everything the print path imports before opening the device
+            "print": [sys.executable, "-c", "import usb1, ptouch.ptd600, ptouch.client, ptouch.label"],
+        }
+        results = {}
+        for name, cmd in cases.items():
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                subprocess.run(cmd, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+                t = (time.perf_counter() - start) * 1000
+                best = t if best is None else min(best, t)
+            results[name] = best
+            print("%-12s %8.1f ms (budget %d ms)" % (name, best, startup_budgets[name]))
+    return results
+
+
+def compare(summary, baseline, threshold):
+    # Returns False when any stage is slower than the baseline by more than threshold
+    ok = True
+    print("\n%-16s %10s %10s %8s" % ("stage", "baseline", "current", "change"))
+    for stage in stages + ["labels_per_sec", "bytes"]:
+        old = baseline["summary"].get(stage)
+        new = summary[stage]
+        if not old:
+            continue
+        change = (new - old) / old
+        # higher is better for throughput
+        worse = -change if stage == "labels_per_sec" else change
+        flag = ""
+        if worse > threshold:
+            flag = "REGRESSION"
+            ok = False
+        print("%-16s %10.2f %10.2f %+7.1f%% %s" % (stage, old, new, change * 100, flag))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-w", "--width", type=int, action="append", choices=sorted(tape_sizes))
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json")
+    parser.add_argument("-b", "--baseline", type=str)
+    parser.add_argument("-t", "--threshold", type=float, default=0.1)
+    parser.add_argument("-s", "--startup", action="store_true", help="measure CLI startup time against budgets")
+    args = parser.parse_args()
+
+    if args.startup:
+        startup = run_startup(args.repeat)
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "startup": startup}, f, indent=2)
+        over = [name for name, t in startup.items() if t > startup_budgets[name]]
+        if over:
+            print("Over budget: %s" % ", ".join(over))
+            sys.exit(1)
+        sys.exit()
+
+    results, summary = run(args.width or sorted(tape_sizes), args.repeat)
+
+    print("\nAverage per label:")
+    for stage in stages:
+        print("  %-10s %8.2f ms" % (stage, summary[stage]))
+    print("  %.1f labels/s, %d bytes sent" % (summary["labels_per_sec"], summary["bytes"]))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "summary": summary,
+            "results": results,
+        }, f, indent=2)
+    print("Saved %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if not compare(summary, baseline, args.threshold):
+            sys.exit(1)
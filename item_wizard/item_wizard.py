@@ -2,20 +2,27 @@
 import os
 import sys
 import logging
-import csv
 
-from PySide2.QtCore import QObject, QThread, Signal, Slot
+from PySide2.QtCore import Qt, QObject, QThread, QTimer, Signal, Slot, QAbstractListModel, QModelIndex, QStringListModel
 from PySide2.QtGui import QPixmap
-from PySide2.QtWidgets import QApplication, QLineEdit, QPushButton, QStatusBar, QLabel, QRadioButton, QComboBox
+from PySide2.QtWidgets import QApplication, QLineEdit, QPushButton, QStatusBar, QLabel, QRadioButton, QComboBox, QCompleter
 from PySide2.QtUiTools import QUiLoader
 
 from PIL import Image, ImageQt
 
 from ptouch.label import Label
-from ptouch.ptd600 import PTD600
+from ptouch.client import print_images
+from ptouch.items import ItemStore
 
 log = logging.getLogger(__name__)
 
+# ms without edits before the preview is rendered
+PREVIEW_DELAY = 50
+
+ITEMS_DB = "items.db"
+# imported into ITEMS_DB when it is first created
+ITEMS_CSV = "items.csv"
+
 
 def get_children(widget):
     for obj in widget.children():
@@ -47,26 +54,87 @@ class Worker(QObject):
     @Slot(Image.Image)
     def print(self, img):
         try:
-            log.info("Open PTouch...")
-            with PTD600.open() as ptouch:
-                ptouch.log_info()
-
-                if ptouch.tape_px != img.height:
-                    raise Exception("Incorrect Tape Size")
-
-                log.info("Printing Label..")
-                self.gui_status.emit("Printing Label..")
-                ptouch.print_img(img)
-                log.info("Done")
-                self.gui_status.emit("Done")
+            self.gui_status.emit("Printing Label..")
+            print_images([img])
+            log.info("Done")
+            self.gui_status.emit("Done")
 
         except Exception as e:
             log.exception("Error")
             self.gui_status.emit(str(e))
 
 
+class ItemModel(QAbstractListModel):
+    # Loads items from the store a page at a time as the list is scrolled
+    PAGE_SIZE = 200
+
+    def __init__(self, store : ItemStore):
+        super(ItemModel, self).__init__()
+        self.store = store
+        self.reload()
+
+    def reload(self):
+        self.beginResetModel()
+        self.rows = [("New...", None)]
+        self.total = self.store.count()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and len(self.rows) - 1 < self.total
+
+    def fetchMore(self, parent):
+        items = self.store.page(len(self.rows) - 1, self.PAGE_SIZE)
+        if not items:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(items) - 1)
+        self.rows += [(f"{id:05d}: {title}", id) for id, title, subtitle in items]
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        text, id = self.rows[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return text
+        if role == Qt.UserRole:
+            return id
+        return None
+
+
+class Renderer(QObject):
+    rendered = Signal(int, object)
+
+    def __init__(self):
+        # No parent, so the object can be moved to the render thread
+        super(Renderer, self).__init__(None)
+        # only used from the render thread
+        self.label = Label("", "", "", "")
+        # sequence number of the newest request, set from the GUI thread
+        self.latest = 0
+
+    @Slot(int, object)
+    def render(self, seq, params):
+        # Skip requests that were superseded while they were queued
+        if seq != self.latest:
+            return
+
+        title, subtitle, id, qr, ratio, height = params
+        try:
+            self.label.update(title=title, subtitle=subtitle, id=id, qrdata=qr, height=height, title_ratio=ratio)
+            img = self.label.render()
+            qimg = ImageQt.ImageQt(img)
+        except Exception:
+            log.exception("Preview failed")
+            return
+        self.rendered.emit(seq, qimg)
+
+
 class App(QApplication):
     worker_print = Signal(Image.Image)
+    render_request = Signal(int, object)
 
     def __init__(self, argv):
         super(App, self).__init__(argv)
@@ -79,33 +147,50 @@ class App(QApplication):
         for w in get_children(self.window):
             setattr(self, w[1], self.window.findChild(w[0], w[1]))
 
-        # self.thread = QThread()
-        # self.worker = Worker(self)
-        # self.worker.moveToThread(self.thread)
-        # self.thread.start()
+        # Print on a separate thread, printing waits until the label is out of the printer
+        self.thread = QThread()
+        self.worker = Worker(self)
+        self.worker.moveToThread(self.thread)
+        self.thread.start()
+        self.aboutToQuit.connect(self.thread.quit)
 
-        self.data = {}
+        new_store = not os.path.exists(ITEMS_DB)
+        self.store = ItemStore(ITEMS_DB)
+        if new_store and os.path.exists(ITEMS_CSV):
+            self.store.import_csv(ITEMS_CSV)
 
-        try:
-            with open("items.csv", "r", newline="") as f:
-                csvreader = csv.reader(f)
-                for line in csvreader:
-                    id, title, subtitle = line
-                    id = int(id)
-                    self.data[id] = (title, subtitle)
-        except:
-            pass
-
-        if len(self.data):
-            self.next_id = max(self.data.keys()) + 1
-        else:
-            self.next_id = 1
+        self.next_id = self.store.next_id()
         self.idEdit.setText(f"{self.next_id:05d}")
 
-        self.comboBox.addItem("New...", None)
-        for id, (title, subtitle) in self.data.items():
-            print(f"{id} - {title} - {subtitle}")
-            self.comboBox.addItem(f"{id:05d}: {title}", id)
+        self.items_model = ItemModel(self.store)
+        self.comboBox.setModel(self.items_model)
+
+        # Type in the combo box to search by id, title or subtitle
+        self.comboBox.setEditable(True)
+        self.comboBox.setInsertPolicy(QComboBox.NoInsert)
+        self.search_results = {}
+        self.search_model = QStringListModel()
+        completer = QCompleter(self.search_model, self.comboBox)
+        completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.comboBox.setCompleter(completer)
+        self.comboBox.lineEdit().textEdited.connect(self.search)
+        completer.activated[str].connect(self.search_select)
+
+        # Render previews on a separate thread, only the newest request is rendered
+        self.render_thread = QThread()
+        self.renderer = Renderer()
+        self.renderer.moveToThread(self.render_thread)
+        self.render_thread.start()
+        self.aboutToQuit.connect(self.render_thread.quit)
+        self.render_seq = 0
+        self.render_request.connect(self.renderer.render)
+        self.renderer.rendered.connect(self.show_preview)
+
+        # Wait for typing to pause before rendering
+        self.preview_timer = QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.request_preview)
 
         self.update()
 
@@ -120,13 +205,26 @@ class App(QApplication):
 
         self.comboBox.activated.connect(self.select)
         self.printButton.pressed.connect(self.print)
-        # self.worker_print.connect(self.worker.print)
+        self.worker_print.connect(self.worker.print)
 
     @Slot(int)
     def select(self, index):
-        id = self.comboBox.itemData(index)
-        if id is not None:
-            title, subtitle = self.data[id]
+        self.select_id(self.comboBox.itemData(index))
+
+    @Slot(str)
+    def search(self, text):
+        results = self.store.search(text)
+        self.search_results = {f"{id:05d}: {title}": id for id, title, subtitle in results}
+        self.search_model.setStringList(list(self.search_results))
+
+    @Slot(str)
+    def search_select(self, text):
+        self.select_id(self.search_results.get(text))
+
+    def select_id(self, id):
+        item = self.store.get(id) if id is not None else None
+        if item is not None:
+            title, subtitle = item
             self.titleEdit.setText(title)
             self.title2Edit.setText(subtitle)
             self.subtitleEdit.setText(subtitle)
@@ -149,51 +247,42 @@ class App(QApplication):
     def save(self):
         title, subtitle, id, qr, ratio = self.params()
         id = int(id)
-        self.data[id] = (title, subtitle)
-        with open("items.csv", "a", newline="") as f:
-            csvwriter = csv.writer(f)
-            csvwriter.writerow([ id, title, subtitle ])
-        self.comboBox.addItem(f"{id:05d}: {title}", id)
-        self.next_id = id + 1
+        self.store.save(id, title, subtitle)
+        self.items_model.reload()
+        self.next_id = max(id + 1, self.store.next_id())
         self.idEdit.setText(f"{self.next_id:05d}")
 
-    def render(self):
-        title, subtitle, id, qr, ratio = self.params()
+    def tape_height(self):
         size = self.tape24mm.isChecked()
-        height = (128 if size else 76)
+        return (128 if size else 76)
 
-        label = Label(title, subtitle, id, qr, height=height, title_ratio=ratio)
+    def render(self):
+        title, subtitle, id, qr, ratio = self.params()
+        label = Label(title, subtitle, id, qr, height=self.tape_height(), title_ratio=ratio)
         return label.render()
 
     @Slot()
     def update(self):
-        img = self.render()
-        qimg = ImageQt.ImageQt(img)
+        self.preview_timer.start()
+
+    @Slot()
+    def request_preview(self):
+        self.render_seq += 1
+        self.renderer.latest = self.render_seq
+        self.render_request.emit(self.render_seq, self.params() + (self.tape_height(),))
+
+    @Slot(int, object)
+    def show_preview(self, seq, qimg):
+        # A newer preview is on its way
+        if seq != self.render_seq:
+            return
         self.imageLabel.setPixmap(QPixmap.fromImage(qimg))
 
     @Slot()
     def print(self):
         img = self.render()
         self.save()
-        # self.worker_print.emit(img)
-
-        try:
-            log.info("Open PTouch...")
-            with PTD600.open() as ptouch:
-                ptouch.log_info()
-
-                if ptouch.tape_px != img.height:
-                    raise Exception("Incorrect Tape Size")
-
-                log.info("Printing Label..")
-                self.status("Printing Label..")
-                ptouch.print_img(img)
-                log.info("Done")
-                self.status("Done")
-
-        except Exception as e:
-            log.exception("Error")
-            self.status(str(e))
+        self.worker_print.emit(img)
 
     @Slot(str)
     def status(self, text):
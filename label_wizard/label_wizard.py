@@ -3,7 +3,7 @@ import os
 import sys
 import logging
 
-from PySide2.QtCore import QObject, QThread, Signal, Slot
+from PySide2.QtCore import QObject, QThread, QTimer, Signal, Slot
 from PySide2.QtGui import QPixmap
 from PySide2.QtWidgets import QApplication, QLineEdit, QPushButton, QStatusBar, QLabel, QRadioButton
 from PySide2.QtUiTools import QUiLoader
@@ -11,10 +11,13 @@ from PySide2.QtUiTools import QUiLoader
 from PIL import Image, ImageQt
 
 from ptouch.label import Label
-from ptouch.ptd600 import PTD600
+from ptouch.client import print_images
 
 log = logging.getLogger(__name__)
 
+# ms without edits before the preview is rendered
+PREVIEW_DELAY = 50
+
 
 def get_children(widget):
     for obj in widget.children():
@@ -46,26 +49,47 @@ class Worker(QObject):
     @Slot(Image.Image)
     def print(self, img):
         try:
-            log.info("Open PTouch...")
-            with PTD600.open() as ptouch:
-                ptouch.log_info()
-
-                if ptouch.tape_px != img.height:
-                    raise Exception("Incorrect Tape Size")
-
-                log.info("Printing Label..")
-                self.gui_status.emit("Printing Label..")
-                ptouch.print_img(img)
-                log.info("Done")
-                self.gui_status.emit("Done")
+            self.gui_status.emit("Printing Label..")
+            print_images([img])
+            log.info("Done")
+            self.gui_status.emit("Done")
 
         except Exception as e:
             log.exception("Error")
             self.gui_status.emit(str(e))
 
 
+class Renderer(QObject):
+    rendered = Signal(int, object)
+
+    def __init__(self):
+        # No parent, so the object can be moved to the render thread
+        super(Renderer, self).__init__(None)
+        # only used from the render thread
+        self.label = Label("", "", "", "")
+        # sequence number of the newest request, set from the GUI thread
+        self.latest = 0
+
+    @Slot(int, object)
+    def render(self, seq, params):
+        # Skip requests that were superseded while they were queued
+        if seq != self.latest:
+            return
+
+        title, subtitle, id, qr, ratio, height = params
+        try:
+            self.label.update(title=title, subtitle=subtitle, id=id, qrdata=qr, height=height, title_ratio=ratio)
+            img = self.label.render()
+            qimg = ImageQt.ImageQt(img)
+        except Exception:
+            log.exception("Preview failed")
+            return
+        self.rendered.emit(seq, qimg)
+
+
 class App(QApplication):
     worker_print = Signal(Image.Image)
+    render_request = Signal(int, object)
 
     def __init__(self, argv):
         super(App, self).__init__(argv)
@@ -83,6 +107,22 @@ class App(QApplication):
         self.worker.moveToThread(self.thread)
         self.thread.start()
 
+        # Render previews on a separate thread, only the newest request is rendered
+        self.render_thread = QThread()
+        self.renderer = Renderer()
+        self.renderer.moveToThread(self.render_thread)
+        self.render_thread.start()
+        self.aboutToQuit.connect(self.render_thread.quit)
+        self.render_seq = 0
+        self.render_request.connect(self.renderer.render)
+        self.renderer.rendered.connect(self.show_preview)
+
+        # Wait for typing to pause before rendering
+        self.preview_timer = QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.request_preview)
+
         self.update()
 
         self.titleEdit.textChanged.connect(self.update)
@@ -97,7 +137,7 @@ class App(QApplication):
         self.printButton.pressed.connect(self.print)
         self.worker_print.connect(self.worker.print)
 
-    def render(self):
+    def params(self):
         title = self.titleEdit.text()
         if self.subtitleEdit.isEnabled():
             subtitle = self.subtitleEdit.text()
@@ -107,15 +147,33 @@ class App(QApplication):
             ratio = 0.5
         id = self.idEdit.text()
         qr = self.qrEdit.text()
+
+        return title, subtitle, id, qr, ratio
+
+    def tape_height(self):
         size = self.tape24mm.isChecked()
-        height = (128 if size else 76)
+        return (128 if size else 76)
 
-        label = Label(title, subtitle, id, qr, height=height, title_ratio=ratio)
+    def render(self):
+        title, subtitle, id, qr, ratio = self.params()
+        label = Label(title, subtitle, id, qr, height=self.tape_height(), title_ratio=ratio)
         return label.render()
 
+    @Slot()
     def update(self):
-        img = self.render()
-        qimg = ImageQt.ImageQt(img)
+        self.preview_timer.start()
+
+    @Slot()
+    def request_preview(self):
+        self.render_seq += 1
+        self.renderer.latest = self.render_seq
+        self.render_request.emit(self.render_seq, self.params() + (self.tape_height(),))
+
+    @Slot(int, object)
+    def show_preview(self, seq, qimg):
+        # A newer preview is on its way
+        if seq != self.render_seq:
+            return
         self.imageLabel.setPixmap(QPixmap.fromImage(qimg))
 
     def print(self):
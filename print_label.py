@@ -1,54 +1,322 @@
 
+
+import os
+import sys
+import time
 import argparse
 
-import usb1
-from ptouch.ptd600 import PTD600
-from ptouch.label import Label
+# Dependencies are imported where they are first needed, to keep --help and previews fast
+
+
+def progress(labels, imgs):
+    for i, (label, img) in enumerate(zip(labels, imgs)):
+        print("[%d/%d] %s" % (i + 1, len(labels), label["title"]))
+        yield img
+
+
+def print_resumable(ptouch, images, compress : bool, jobs=None):
+    # Print and wait, after a printer fault continue with the labels that did not print
+    from ptouch.ptd600 import PrinterError
+    from ptouch.resume import PrintJob
+
+    job = PrintJob(images, compress, jobs)
+    run = job.run
+    while True:
+        try:
+            return run(ptouch)
+        except PrinterError as e:
+            print("Printer error after %d of %d labels: %s" % (job.printed, len(job.images), e))
+            print("Waiting for the fault to be cleared..")
+            run = job.resume
+
+
+def run_batch(args, max_length):
+    from ptouch.batch import read_labels, render_labels
+    from ptouch.pipeline import render_parallel
+
+    f = sys.stdin if args.batch == "-" else open(args.batch, "r", newline="")
+    with f:
+        labels = list(read_labels(f, args.qr_format))
+    print("Batch: %d labels" % len(labels))
+
+    start = time.perf_counter()
+    sent = 0
+    # render in a process pool when --jobs is given
+    render = render_parallel if args.jobs else render_labels
+    kwargs = {"workers": args.jobs} if args.jobs else {}
+
+    if args.dry_run:
+        os.makedirs(args.dry_run, exist_ok=True)
+        imgs = render(labels, args.height, max_length=max_length, **kwargs)
+        for i, img in enumerate(progress(labels, imgs)):
+            img.save(os.path.join(args.dry_run, "label_%04d.png" % (i + 1)))
+    else:
+        from ptouch.ptd600 import PTD600
+        from ptouch.client import connect
+        from ptouch.pipeline import encode_parallel
+        from ptouch.batch import make_labels
+        from ptouch.rastercache import RasterCache
+
+        client = None if args.all_printers else connect()
+        if args.all_printers:
+            from ptouch.pool import PrinterPool
+            with PrinterPool.open(chunk_size=args.chunk_size or PTD600.CHUNK_SIZE) as pool:
+                print("Opened %d printers: %s" % (len(pool.printers),
+                      ", ".join("%dx %dmm" % (n, w) for w, n in sorted(pool.widths().items()))))
+                # use the tape selected with --height if one is loaded, otherwise the first printer's
+                heights = [p.tape_px for p in pool.printers]
+                height = args.height if args.height in heights else heights[0]
+                imgs = list(progress(labels, render(labels, height, max_length=max_length, **kwargs)))
+                stats = pool.print_batch(imgs, compress=not args.uncompressed)
+        elif client is not None:
+            with client:
+                print("Connected to print server")
+                height = client.status()["tape_px"]
+                imgs = progress(labels, render(labels, height, max_length=max_length, **kwargs))
+                stats = client.print_batch(imgs, compress=not args.uncompressed)
+        else:
+            with PTD600.open(serial=args.printer, chunk_size=args.chunk_size or PTD600.CHUNK_SIZE) as ptouch:
+                print("Opened PTD600")
+                ptouch.log_info()
+                items = list(make_labels(labels, ptouch.tape_px, max_length=max_length))
+                if args.jobs:
+                    # transmit each label while the following ones are rendered
+                    jobs = encode_parallel(ptouch.encoder(), labels, compress=not args.uncompressed,
+                                           workers=args.jobs, max_length=max_length)
+                    stats = print_resumable(ptouch, items, not args.uncompressed, progress(labels, jobs))
+                elif not args.no_cache:
+                    # reprints come straight from the raster cache
+                    cache = RasterCache()
+                    jobs = cache.build_jobs(ptouch.encoder(), items, compress=not args.uncompressed)
+                    stats = print_resumable(ptouch, items, not args.uncompressed, progress(labels, jobs))
+                    print("Raster cache: %d hits, %d misses" % (cache.hits, cache.misses))
+                else:
+                    imgs = progress(labels, render_labels(labels, ptouch.tape_px, max_length=max_length))
+                    stats = print_resumable(ptouch, imgs, compress=not args.uncompressed)
+        sent = sum(st.sent_bytes for st in stats)
+
+    elapsed = time.perf_counter() - start
+    print("Done: %d labels in %.2fs, %.1f labels/s, %d bytes sent" %
+          (len(labels), elapsed, len(labels) / elapsed if elapsed else 0, sent))
+
+
+def run_range(args):
+    # Numbered run of labels sharing title and subtitle, the title is only rendered once
+    from ptouch.template import LabelTemplate, parse_range, QR_FORMAT
+
+    ids = parse_range(args.range)
+    qr_format = args.qr_format or QR_FORMAT
+    print("Range: %d labels" % len(ids))
+
+    def numbered(template, items):
+        for i, (n, item) in enumerate(zip(ids, items)):
+            print("[%d/%d] %s" % (i + 1, len(ids), template.fields(n)[0]))
+            yield item
+
+    start = time.perf_counter()
+    sent = 0
+    if args.dry_run:
+        os.makedirs(args.dry_run, exist_ok=True)
+        template = LabelTemplate(args.title, args.subtitle, qr_format, height=args.height)
+        for n, img in zip(ids, numbered(template, map(template.render, ids))):
+            img.save(os.path.join(args.dry_run, "label_%05d.png" % n))
+    else:
+        from ptouch.ptd600 import PTD600
+        from ptouch.client import connect
+
+        client = connect()
+        if client is not None:
+            with client:
+                print("Connected to print server")
+                template = LabelTemplate(args.title, args.subtitle, qr_format, height=client.status()["tape_px"])
+                stats = client.print_batch(numbered(template, map(template.render, ids)),
+                                           compress=not args.uncompressed)
+        else:
+            with PTD600.open(serial=args.printer, chunk_size=args.chunk_size or PTD600.CHUNK_SIZE) as ptouch:
+                print("Opened PTD600")
+                ptouch.log_info()
+                template = LabelTemplate(args.title, args.subtitle, qr_format, height=ptouch.tape_px)
+                jobs = template.build_jobs(ptouch.encoder(), ids, compress=not args.uncompressed)
+                stats = print_resumable(ptouch, [template.make_label(n) for n in ids], not args.uncompressed,
+                                        numbered(template, jobs))
+        sent = sum(st.sent_bytes for st in stats)
+
+    elapsed = time.perf_counter() - start
+    print("Done: %d labels in %.2fs, %.1f labels/s, %d bytes sent" %
+          (len(ids), elapsed, len(ids) / elapsed if elapsed else 0, sent))
+
+
+def run_image(args):
+    # Print an image or logo file scaled to the tape, instead of a text label
+    from ptouch.picture import Picture
+
+    if not (args.print or args.no_print):
+        print("Preview Image...")
+        img = Picture(args.image, height=args.height, method=args.dither).render()
+        if args.output:
+            img.save(args.output)
+        else:
+            img.show()
+        return
+
+    from ptouch.ptd600 import PTD600
+    from ptouch.client import connect
+
+    client = connect()
+    if client is not None:
+        with client:
+            print("Connected to print server")
+            height = client.status()["tape_px"]
+            if not args.no_print:
+                print("Printing Image..")
+                client.print_img(Picture(args.image, height=height, method=args.dither).render(),
+                                 compress=not args.uncompressed)
+    else:
+        with PTD600.open(serial=args.printer, chunk_size=args.chunk_size or PTD600.CHUNK_SIZE) as ptouch:
+            print("Opened PTD600")
+            ptouch.log_info()
+            if not args.no_print:
+                print("Printing Image..")
+                picture = Picture(args.image, height=ptouch.tape_px, method=args.dither)
+                if args.no_cache:
+                    print_resumable(ptouch, [picture], not args.uncompressed)
+                else:
+                    from ptouch.rastercache import RasterCache
+                    jobs = RasterCache().build_jobs(ptouch.encoder(), [picture], compress=not args.uncompressed)
+                    print_resumable(ptouch, [picture], not args.uncompressed, jobs)
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument("title")
+parser.add_argument("title", nargs="?", type=str, default="")
 parser.add_argument("qr", nargs="?", type=str, default="")
 parser.add_argument("-S", "--subtitle", type=str, default="")
 parser.add_argument("-I", "--id", type=str, default="")
 parser.add_argument("-H", "--height", type=int, default=128)
+parser.add_argument("-i", "--image", type=str, help="print a PNG, JPEG or SVG image scaled to the tape instead of a label")
+parser.add_argument("--dither", choices=("floyd", "ordered", "threshold"), default="floyd", help="dithering for --image")
+parser.add_argument("-B", "--banner", action="store_true", help="print the title as a single line banner of any length, streamed while it is rendered")
+parser.add_argument("-L", "--length", type=float, help="maximum label length in mm")
 parser.add_argument("-p", "--print", action="store_true")
 parser.add_argument("-n", "--no-print", action="store_true")
+parser.add_argument("-u", "--uncompressed", action="store_true")
+parser.add_argument("--no-cache", action="store_true", help="always render, do not use the raster cache")
+parser.add_argument("-c", "--chunk-size", type=int, help="bytes per USB transfer, default 16384")
+parser.add_argument("-P", "--printer", type=str, metavar="SERIAL", help="use the PTD600 with this serial number")
+parser.add_argument("-A", "--all-printers", action="store_true", help="spread batch labels over all printers with matching tape")
+parser.add_argument("-l", "--list-printers", action="store_true", help="list connected printers and their tape")
+parser.add_argument("-b", "--batch", type=str, help="CSV or JSONL file of labels, - for stdin")
+parser.add_argument("-R", "--range", type=str, metavar="START-END", help="numbered run of the title with ids START to END, or START+COUNT")
+parser.add_argument("-q", "--qr-format", type=str, help="QR data for batch rows without one, e.g. https://znnxs.com/item/{id}")
+parser.add_argument("-j", "--jobs", type=int, help="render batch labels in this many processes")
+parser.add_argument("-d", "--dry-run", type=str, metavar="DIR", help="write batch labels as PNGs instead of printing")
+parser.add_argument("-r", "--report", action="store_true", help="print stage timings and USB counters as JSON when done")
+parser.add_argument("-o", "--output", type=str, help="save the preview to a file instead of showing it")
 args = parser.parse_args()
 
+from ptouch.label import Label, mm_to_px
+
+max_length = mm_to_px(args.length) if args.length else None
+
+if args.list_printers:
+    import usb1
+    from ptouch.ptd600 import PTD600, find_printers
+
+    with usb1.USBContext() as context:
+        for pid, device in find_printers(context):
+            try:
+                with PTD600.claim(device.open()) as ptouch:
+                    print("%s: %dmm tape, %dpx" % (pid, ptouch.status.media_width, ptouch.tape_px))
+            except Exception as e:
+                print("%s: %s" % (pid, e))
+    parser.exit()
+
+def print_report():
+    import json
+    from ptouch import metrics
+    print(json.dumps(metrics.snapshot(), indent=2))
+
+
+if args.batch:
+    run_batch(args, max_length)
+    if args.report:
+        print_report()
+    parser.exit()
+elif args.image:
+    run_image(args)
+    if args.report:
+        print_report()
+    parser.exit()
+elif args.range:
+    if not args.title:
+        parser.error("--range needs a title")
+    run_range(args)
+    if args.report:
+        print_report()
+    parser.exit()
+elif not args.title:
+    parser.error("a title or --batch is required")
+
 print("Title: %s" % args.title)
 print("Subtitle: %s" % args.subtitle)
 print("ID: %s" % args.id)
 print("QR: %s" % args.qr)
 
 if args.print or args.no_print:
-    with usb1.USBContext() as context:
-        handle = context.openByVendorIDAndProductID(PTD600.VID, PTD600.PID)
-        if handle is None:
-            # Device not present, or user is not allowed to access device.
-            print("Unable to open PTD600")
-        else:
-            try:
-                handle.detachKernelDriver(PTD600.INTF)
-            except:
-                pass
+    from ptouch.client import connect
+    client = connect()
+else:
+    client = None
 
-            with handle.claimInterface(PTD600.INTF):
-                # Do stuff with endpoints on claimed interface.
-                print("Opened PTD600")
+if client is not None:
+    with client:
+        print("Connected to print server")
+        status = client.status()
+        print("Tape: %dmm, %dpx" % (status["media_width"], status["tape_px"]))
+        if not args.no_print and args.banner:
+            from ptouch.banner import Banner
+            print("Printing Banner..")
+            client.print_img(Banner(args.title, height=status["tape_px"]).render(), compress=not args.uncompressed)
+        elif not args.no_print:
+            print("Printing Label..")
+            label = Label(args.title, args.subtitle, args.id, args.qr, height=status["tape_px"], max_length=max_length)
+            img = label.render()
+            client.print_img(img, compress=not args.uncompressed)
 
-                ptouch = PTD600(handle)
-                ptouch.log_info()
-                if not args.no_print:
-                    print("Printing Label..")
-                    label = Label(args.title, args.subtitle, args.id, args.qr, height=ptouch.tape_px)
-                    img = label.render()
-                    ptouch.print_img(img)
+elif args.print or args.no_print:
+    from ptouch.ptd600 import PTD600
+
+    with PTD600.open(serial=args.printer, chunk_size=args.chunk_size or PTD600.CHUNK_SIZE) as ptouch:
+        print("Opened PTD600")
+        ptouch.log_info()
+        if not args.no_print and args.banner:
+            from ptouch.banner import Banner
+            print("Printing Banner..")
+            banner = Banner(args.title, height=ptouch.tape_px)
+            ptouch.print_stream(banner.chunks(), compress=not args.uncompressed)
+        elif not args.no_print:
+            print("Printing Label..")
+            label = Label(args.title, args.subtitle, args.id, args.qr, height=ptouch.tape_px, max_length=max_length)
+            if args.no_cache:
+                print_resumable(ptouch, [label], compress=not args.uncompressed)
+            else:
+                from ptouch.rastercache import RasterCache
+                jobs = RasterCache().build_jobs(ptouch.encoder(), [label], compress=not args.uncompressed)
+                print_resumable(ptouch, [label], not args.uncompressed, jobs)
 
 else:
     print("Preview Label...")
-    label = Label(args.title, args.subtitle, args.id, args.qr, height=args.height)
-    # label = Label("Test Label", "Test Subtitle", "TESTLABL", "https://www.google.com")
-    # label = Label("Test Label", "", "", "https://www.google.com")
-    img = label.render()
-    img.show()
+    if args.banner:
+        from ptouch.banner import Banner
+        img = Banner(args.title, height=args.height).render()
+    else:
+        label = Label(args.title, args.subtitle, args.id, args.qr, height=args.height, max_length=max_length)
+        # label = Label("Test Label", "Test Subtitle", "TESTLABL", "https://www.google.com")
+        # label = Label("Test Label", "", "", "https://www.google.com")
+        img = label.render()
+    if args.output:
+        img.save(args.output)
+    else:
+        img.show()
+
+if args.report:
+    print_report()
@@ -0,0 +1,22 @@
+import importlib
+
+# Submodules are only imported when one of their names is first used,
+# so importing ptouch does not load Pillow, qrcode or usb1
+_exports = {
+    "Label": "label",
+    "rendertext": "label",
+    "PTD600": "ptd600",
+    "RasterEncoder": "ptd600",
+    "PrinterError": "ptd600",
+    "AsyncPTD600": "aio",
+    "PrinterPool": "pool",
+    "PrintClient": "client",
+    "print_images": "client",
+}
+
+
+def __getattr__(name):
+    if name in _exports:
+        module = importlib.import_module("." + _exports[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,291 @@
+import time
+import select
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+from PIL import Image
+
+from .metrics import timed, record_write
+from .ptd600 import PTD600, RasterEncoder, PrinterError, open_handle, wait_printed, STATUS_REPLY
+from .resume import PrintJob, READY_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+
+class AsyncPTD600(RasterEncoder):
+    # asyncio counterpart of PTD600, using libusb asynchronous transfers.
+    # libusb events are handled on the event loop through its poll file descriptors.
+    SEND_EP = PTD600.SEND_EP
+    RECV_EP = PTD600.RECV_EP
+
+    CHUNK_SIZE = PTD600.CHUNK_SIZE
+    MIN_CHUNK_SIZE = PTD600.MIN_CHUNK_SIZE
+    IN_FLIGHT = 4
+    WRITE_TIMEOUT = PTD600.WRITE_TIMEOUT
+    STATUS_TIMEOUT = PTD600.STATUS_TIMEOUT
+    PRINT_TIMEOUT = PTD600.PRINT_TIMEOUT
+
+    def __init__(self, context : "usb1.USBContext", handle : "usb1.USBDeviceHandle",
+                 chunk_size : int = CHUNK_SIZE, in_flight : int = IN_FLIGHT):
+        super().__init__()
+        self.context = context
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight
+        # newest status block, status() asks the printer for a fresh one
+        self.last_status = None
+        # last print job, resume() finishes it after a PrinterError
+        self.job = None
+        self.loop = asyncio.get_running_loop()
+        self.timer = None
+
+    @classmethod
+    @asynccontextmanager
+    async def open(cls, serial : str = None, bus : int = None, address : int = None, **kwargs):
+        # Opens a PTD600 like PTD600.open
+        import usb1
+
+        with usb1.USBContext() as context:
+            handle = open_handle(context, serial, bus, address)
+            try:
+                handle.detachKernelDriver(PTD600.INTF)
+            except:
+                pass
+
+            with handle.claimInterface(PTD600.INTF):
+                ptouch = cls(context, handle, **kwargs)
+                ptouch.watch()
+                try:
+                    await ptouch.init()
+                    await ptouch.getstatus()
+                    yield ptouch
+                finally:
+                    ptouch.unwatch()
+
+    def watch(self):
+        # Let the event loop tell us when libusb has events to handle
+        for fd, events in self.context.getPollFDList():
+            self.add_fd(fd, events, None)
+        self.context.setPollFDNotifiers(self.add_fd, self.remove_fd)
+
+    def unwatch(self):
+        self.context.setPollFDNotifiers()
+        for fd, events in self.context.getPollFDList():
+            self.remove_fd(fd, None)
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def add_fd(self, fd, events, user_data):
+        if events & select.POLLIN:
+            self.loop.add_reader(fd, self.handle_events)
+        if events & select.POLLOUT:
+            self.loop.add_writer(fd, self.handle_events)
+
+    def remove_fd(self, fd, user_data):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def handle_events(self):
+        self.context.handleEventsTimeout(0)
+        self.schedule_timeout()
+
+    def schedule_timeout(self):
+        # Transfer timeouts need handling too, when the platform has no timerfd
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        timeout = self.context.getNextTimeout()
+        if timeout is not None:
+            self.timer = self.loop.call_later(timeout, self.handle_events)
+
+    def submit(self, endpoint : int, data, timeout : int):
+        # Starts a bulk transfer, returns a future for the data read or the length written
+        import usb1
+
+        future = self.loop.create_future()
+        start = time.perf_counter()
+
+        def done(transfer):
+            status = transfer.getStatus()
+            length = transfer.getActualLength()
+            data = bytes(transfer.getBuffer()[:length])
+            # freed once the callback returns
+            transfer.doom()
+            if not endpoint & 0x80:
+                record_write(length, time.perf_counter() - start)
+            if future.done():
+                return
+            if status == usb1.TRANSFER_COMPLETED:
+                future.set_result(data if endpoint & 0x80 else length)
+            elif status == usb1.TRANSFER_TIMED_OUT:
+                error = usb1.USBErrorTimeout()
+                error.transferred = length
+                future.set_exception(error)
+            elif status == usb1.TRANSFER_CANCELLED:
+                future.cancel()
+            else:
+                future.set_exception(Exception("USB transfer failed, status %d" % status))
+
+        def cancelled(future):
+            if future.cancelled() and transfer.isSubmitted():
+                transfer.cancel()
+
+        transfer = self.handle.getTransfer()
+        transfer.setBulk(endpoint, data, callback=done, timeout=timeout)
+        transfer.submit()
+        future.add_done_callback(cancelled)
+        self.schedule_timeout()
+        return future
+
+    async def write(self, data : bytes, timeout : int = 0):
+        return await self.submit(self.SEND_EP, data, timeout)
+
+    async def init(self):
+        await self.write(b'\x1b\x40') # 1B 40 = ESC @ = INIT
+
+    async def reset(self):
+        # 100 x 00 = invalidate, ends any raster data left over from an interrupted job
+        await self.write(bytes(100), self.WRITE_TIMEOUT)
+        await self.init()
+
+    async def send(self, data : bytes, chunk_size : int = None):
+        # Keep up to in_flight chunks queued on the endpoint, they complete in order.
+        # On a write timeout continue with smaller chunks after what was written, like PTD600.send.
+        import usb1
+
+        chunk_size = chunk_size or self.chunk_size
+        pos = 0
+        while pos < len(data):
+            pending = deque()
+            end = pos
+            try:
+                while end < len(data) or pending:
+                    if end < len(data) and len(pending) < self.in_flight:
+                        pending.append((end, self.submit(self.SEND_EP, data[end:end + chunk_size],
+                                                         self.WRITE_TIMEOUT)))
+                        end += chunk_size
+                    else:
+                        start, future = pending.popleft()
+                        pos = start + await future
+            except usb1.USBErrorTimeout as e:
+                pos = start + e.transferred
+                # chunks queued behind it must not have been written, the stream would have a gap
+                if await self.written(pending) or (e.transferred == 0 and chunk_size <= self.MIN_CHUNK_SIZE):
+                    raise
+                chunk_size = max(chunk_size // 2, self.MIN_CHUNK_SIZE)
+                log.warning("Write timeout, reduced chunk size to %d" % chunk_size)
+            finally:
+                # a failed chunk leaves the stream unusable, drop the rest
+                for start, future in pending:
+                    future.cancel()
+        return chunk_size
+
+    async def written(self, pending):
+        # Bytes the queued chunks wrote, once they are done
+        import usb1
+
+        total = 0
+        for start, future in pending:
+            try:
+                total += await future
+            except usb1.USBErrorTimeout as e:
+                total += e.transferred
+        pending.clear()
+        return total
+
+    async def read_status(self, timeout : int = STATUS_TIMEOUT):
+        # Wait for the printer to send a status block, or return None on timeout
+        import usb1
+
+        deadline = time.monotonic() + timeout / 1000
+        while True:
+            remaining = int((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                return None
+            try:
+                buf = await self.submit(self.RECV_EP, 32, remaining)
+            except usb1.USBErrorTimeout:
+                return None
+            # the printer answers with empty reads until a status is ready
+            if len(buf) == 32:
+                break
+            await asyncio.sleep(0.01)
+
+        self.last_status = self.decode_status(buf)
+        return self.last_status
+
+    async def getstatus(self):
+        # 1B 69 53 = ESC i S = Status info request
+        await self.write(b'\x1biS')
+        while True:
+            status = await self.read_status()
+            if status is None:
+                raise Exception("No status reply from PTD600")
+            # skip notifications left over from earlier jobs
+            if status.status_type == STATUS_REPLY:
+                return status
+
+    async def status(self):
+        return await self.getstatus()
+
+    async def drive(self, steps):
+        # PTD600.drive on the event loop
+        import usb1
+
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    result = await getattr(self, call[0])(*call[1:])
+                except usb1.USBError as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    async def wait_until_ready(self, timeout : int = None, interval : float = 0.5):
+        # Poll until the printer reports no errors, like PTD600.wait_until_ready
+        deadline = time.monotonic() + timeout / 1000 if timeout else None
+        while True:
+            status = await self.getstatus()
+            if not status.error:
+                return status
+            if deadline is not None and time.monotonic() > deadline:
+                raise PrinterError(status)
+            await asyncio.sleep(interval)
+
+    async def wait_until_printed(self, pages : int = 1, timeout : int = PRINT_TIMEOUT):
+        with timed("wait"):
+            return await self.drive(wait_printed(pages, timeout, self.STATUS_TIMEOUT))
+
+    async def print_img(self, img : Image.Image, compress : bool = True, wait : bool = True):
+        return (await self.print_batch([img], compress, wait))[0]
+
+    async def print_stream(self, chunks, compress : bool = True, last : bool = True, wait : bool = True):
+        stream = self.stream_job(chunks, compress, last)
+        chunk_size = None
+        while True:
+            try:
+                data = next(stream)
+            except StopIteration as e:
+                stats = e.value
+                break
+            chunk_size = await self.send(data, chunk_size)
+        self.log_stats(stats)
+        if wait:
+            await self.wait_until_printed()
+        return stats
+
+    async def print_batch(self, images, compress : bool = True, wait : bool = True, jobs = None):
+        # Print all labels in one session, only cutting after the last one
+        self.job = PrintJob(images, compress, jobs)
+        return await self.drive(self.job.steps(self, wait))
+
+    async def resume(self, timeout : int = READY_TIMEOUT, wait : bool = True):
+        # Finish the last print job once the printer fault is cleared, like PrintJob.resume
+        if self.job is None:
+            raise Exception("No print job to resume")
+        return await self.drive(self.job.resume_steps(self, timeout, wait))
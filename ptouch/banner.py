@@ -0,0 +1,85 @@
+import re
+import logging
+
+from PIL import Image, ImageDraw
+
+from .label import load_font, TITLE_FONT, MIN_FONT_SIZE
+from .metrics import timed
+
+log = logging.getLogger(__name__)
+
+# columns rendered and sent at a time
+CHUNK_PX = 256
+
+# long words are drawn in pieces, so each chunk only draws a few characters
+_tokens = re.compile(r"\s+|\S{1,16}")
+
+
+class Banner:
+    # Single line label of any length, rendered a chunk of columns at a time,
+    # so the label is never held in memory as a whole
+
+    def __init__(self, text : str, height : int = 128, font : str = TITLE_FONT, chunk_px : int = CHUNK_PX):
+        self.text = text
+        self.height = height
+        self.font_name = font
+        self.chunk_px = chunk_px
+        self.padding = 10
+        self.vspacing = 4
+
+        self.size = self.font_size()
+        self.font = load_font(font, self.size)
+        ascent, descent = self.font.getmetrics()
+        self.y = (height - ascent - descent) // 2
+
+        # origin and horizontal ink extent of each piece of text, only words with ink are kept.
+        # Ink can start left of the origin (j, y, f), so chunks select pieces by their ink.
+        self.pieces = []
+        # furthest any piece's ink reaches left of its origin
+        self.overhang = 0
+        x = self.padding
+        for token in _tokens.findall(text):
+            if not token.isspace():
+                left, top, right, bottom = self.font.getbbox(token)
+                self.pieces.append((x, x + left, x + right, token))
+                self.overhang = max(self.overhang, -left)
+            x += self.font.getlength(token)
+        self.width = int(x) + self.padding
+
+    def font_size(self):
+        # Largest size where ascenders and descenders fit in the tape height
+        lo, hi = MIN_FONT_SIZE, self.height
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            ascent, descent = load_font(self.font_name, mid).getmetrics()
+            if ascent + descent <= self.height - 2 * self.vspacing:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def chunks(self):
+        # Yields consecutive "1" images of up to chunk_px columns, left to right
+        first = 0
+        for x in range(0, self.width, self.chunk_px):
+            with timed("render"):
+                width = min(self.chunk_px, self.width - x)
+                img = Image.new("1", (width, self.height), "white")
+                draw = ImageDraw.Draw(img)
+
+                # pieces are sorted by origin, skip the ones left of this chunk for good
+                while first < len(self.pieces) and self.pieces[first][2] <= x:
+                    first += 1
+                for origin, left, right, token in self.pieces[first:]:
+                    if origin - self.overhang >= x + width:
+                        break
+                    if left < x + width and right > x:
+                        draw.text((origin - x, self.y), token, font=self.font, fill="black")
+            yield img
+
+    def render(self):
+        # The whole banner as one image, for previews
+        img = Image.new("1", (self.width, self.height), "white")
+        for i, chunk in enumerate(self.chunks()):
+            img.paste(chunk, (i * self.chunk_px, 0))
+        return img
@@ -0,0 +1,54 @@
+import csv
+import json
+import logging
+
+from .label import Label
+
+log = logging.getLogger(__name__)
+
+FIELDS = ("title", "subtitle", "id", "qr")
+
+
+def read_labels(f, qr_format : str = None):
+    # Reads JSONL objects, CSV with a header row, or item_wizard's items.csv (id, title, subtitle)
+    text = f.read()
+    if text.lstrip().startswith("{"):
+        rows = (json.loads(line) for line in text.splitlines() if line.strip())
+    else:
+        rows = read_csv(text.splitlines())
+
+    for row in rows:
+        label = {name: str(row.get(name) or "") for name in FIELDS}
+        if not label["qr"] and qr_format:
+            label["qr"] = qr_format.format(id=label["id"])
+        yield label
+
+
+def read_csv(lines):
+    reader = csv.reader(lines)
+    header = None
+    for line in reader:
+        if not line:
+            continue
+        if header is None and "title" in [cell.strip().lower() for cell in line]:
+            header = [cell.strip().lower() for cell in line]
+            continue
+
+        if header is not None:
+            yield dict(zip(header, line))
+        else:
+            # items.csv, numeric ids are zero padded like item_wizard
+            row = dict(zip(("id", "title", "subtitle", "qr"), line))
+            if row["id"].isdigit():
+                row["id"] = f"{int(row['id']):05d}"
+            yield row
+
+
+def make_labels(labels, height : int, **kwargs):
+    for label in labels:
+        yield Label(label["title"], label["subtitle"], label["id"], label["qr"], height=height, **kwargs)
+
+
+def render_labels(labels, height : int, **kwargs):
+    for label in make_labels(labels, height, **kwargs):
+        yield label.render()
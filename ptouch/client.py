@@ -0,0 +1,86 @@
+import json
+import socket
+import logging
+
+from . import metrics
+from .server import SOCKET_PATH, encode_img
+from .ptd600 import PTD600, job_stats
+
+log = logging.getLogger(__name__)
+
+
+class PrintClient:
+    def __init__(self, path : str = SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rwb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def request(self, **req):
+        self.file.write(json.dumps(req).encode() + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise Exception("Print server closed connection")
+        resp = json.loads(line)
+        if not resp["ok"]:
+            raise Exception(resp["error"])
+        return resp
+
+    def status(self):
+        return self.request(cmd="status")["status"]
+
+    def metrics(self):
+        # Counters of the server process, in the Prometheus text format
+        return self.request(cmd="metrics")["text"]
+
+    def resume(self, timeout : int = None):
+        # Finish the job that failed on the server, once the printer fault is cleared
+        resp = self.request(cmd="resume", timeout=timeout)
+        return [job_stats(**st) for st in resp["stats"]]
+
+    def print_img(self, img, compress : bool = True):
+        return self.print_batch([img], compress)[0]
+
+    def print_batch(self, images, compress : bool = True):
+        resp = self.request(cmd="print", images=[encode_img(img) for img in images], compress=compress)
+        return [job_stats(**st) for st in resp["stats"]]
+
+
+def connect(path : str = SOCKET_PATH):
+    # Returns None when no print server is running
+    try:
+        return PrintClient(path)
+    except OSError:
+        return None
+
+
+def print_images(images, compress : bool = True):
+    # Print through the server if it is running, otherwise open the printer directly
+    images = list(images)
+    client = connect()
+    if client is not None:
+        with client:
+            log.info("Printing %d label(s) via print server.." % len(images))
+            return client.print_batch(images, compress)
+
+    log.info("Open PTouch...")
+    with PTD600.open() as ptouch:
+        ptouch.log_info()
+
+        for img in images:
+            if ptouch.tape_px != img.height:
+                raise Exception("Incorrect Tape Size")
+
+        log.info("Printing %d label(s).." % len(images))
+        with metrics.job("print"):
+            return ptouch.print_batch(images, compress)
@@ -0,0 +1,149 @@
+import csv
+import sqlite3
+import logging
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    subtitle TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS items_title ON items (title COLLATE NOCASE);
+"""
+
+# Full-text index kept in sync with the items table
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(title, subtitle, content='items', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS items_ai AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts (rowid, title, subtitle) VALUES (new.id, new.title, new.subtitle);
+END;
+CREATE TRIGGER IF NOT EXISTS items_ad AFTER DELETE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title, subtitle) VALUES ('delete', old.id, old.title, old.subtitle);
+END;
+CREATE TRIGGER IF NOT EXISTS items_au AFTER UPDATE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, title, subtitle) VALUES ('delete', old.id, old.title, old.subtitle);
+    INSERT INTO items_fts (rowid, title, subtitle) VALUES (new.id, new.title, new.subtitle);
+END;
+"""
+
+# ids are shown zero padded to this many digits
+ID_DIGITS = 5
+
+
+def id_ranges(digits : str, max_id : int):
+    # [lo, hi) id ranges whose displayed id starts with digits, plus the id itself,
+    # so "1" finds 1, 10000-19999 and 100000-199999..
+    n = int(digits)
+    ranges = {(n, n + 1)}
+    if len(digits) < ID_DIGITS:
+        scale = 10 ** (ID_DIGITS - len(digits))
+        ranges.add((n * scale, (n + 1) * scale))
+    if not digits.startswith("0"):
+        # longer ids are not padded
+        scale = 10 ** max(ID_DIGITS + 1 - len(digits), 0)
+        while n * scale <= max_id:
+            ranges.add((n * scale, (n + 1) * scale))
+            scale *= 10
+    return sorted((lo, hi) for lo, hi in ranges if lo <= max_id)
+
+
+class ItemStore:
+    def __init__(self, path : str = "items.db"):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5, search falls back to LIKE
+            log.warning("SQLite FTS5 not available")
+            self.fts = False
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def import_csv(self, path : str):
+        # Import item_wizard's items.csv (id, title, subtitle), later rows win like before
+        count = 0
+        errors = 0
+        with open(path, "r", newline="") as f:
+            rows = []
+            for n, line in enumerate(csv.reader(f), 1):
+                if not line:
+                    continue
+                try:
+                    id = int(line[0])
+                    title = line[1] if len(line) > 1 else ""
+                    subtitle = ",".join(line[2:])
+                except ValueError:
+                    log.warning("%s:%d: bad item id: %s" % (path, n, line))
+                    errors += 1
+                    continue
+                rows.append((id, title, subtitle))
+                count += 1
+
+        self.save_many(rows)
+        log.info("Imported %d items from %s, %d errors" % (count, path, errors))
+        return count, errors
+
+    def save(self, id : int, title : str, subtitle : str):
+        self.save_many([(id, title, subtitle)])
+
+    def save_many(self, rows):
+        with self.db:
+            self.db.executemany("INSERT INTO items (id, title, subtitle) VALUES (?, ?, ?) "
+                                "ON CONFLICT (id) DO UPDATE SET title = excluded.title, subtitle = excluded.subtitle",
+                                rows)
+
+    def get(self, id : int):
+        row = self.db.execute("SELECT title, subtitle FROM items WHERE id = ?", (id,)).fetchone()
+        return tuple(row) if row else None
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def next_id(self):
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM items").fetchone()[0]
+
+    def page(self, offset : int, limit : int):
+        return self.db.execute("SELECT id, title, subtitle FROM items ORDER BY id LIMIT ? OFFSET ?",
+                               (limit, offset)).fetchall()
+
+    def search(self, text : str, limit : int = 50):
+        # Prefix match on the zero padded id, plus word prefix search on title and subtitle
+        text = text.strip()
+        if not text:
+            return self.page(0, limit)
+
+        results = []
+        if text.isdecimal():
+            # any unicode digits, as ASCII with the leading zeros kept
+            digits = str(int(text)).zfill(len(text))
+            ranges = id_ranges(digits, self.next_id() - 1)
+            if ranges:
+                # id ranges search the primary key instead of formatting every id
+                where = " OR ".join(["id >= ? AND id < ?"] * len(ranges))
+                params = [bound for r in ranges for bound in r]
+                results += self.db.execute("SELECT id, title, subtitle FROM items WHERE %s ORDER BY id LIMIT ?" % where,
+                                           params + [limit]).fetchall()
+
+        if self.fts:
+            query = " ".join('"%s"*' % word.replace('"', '""') for word in text.split())
+            results += self.db.execute("SELECT items.id, items.title, items.subtitle FROM items_fts "
+                                       "JOIN items ON items.id = items_fts.rowid WHERE items_fts MATCH ? "
+                                       "ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+        else:
+            pattern = "%" + text.replace("%", "").replace("_", "") + "%"
+            results += self.db.execute("SELECT id, title, subtitle FROM items WHERE title LIKE ? OR subtitle LIKE ? "
+                                       "ORDER BY id LIMIT ?", (pattern, pattern, limit)).fetchall()
+
+        seen = set()
+        unique = []
+        for row in results:
+            if row[0] not in seen:
+                seen.add(row[0])
+                unique.append(row)
+        return unique[:limit]
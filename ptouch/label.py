@@ -2,17 +2,62 @@
 import os
 import math
 import logging
+from functools import lru_cache
 
-import qrcode
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageFont, ImageDraw, ImageChops
+
+from .metrics import timed
 
 log = logging.getLogger(__name__)
 
 
-def rendertext(text, size, font="RobotoCondensed-Bold.ttf"):
-    fpath = os.path.dirname(__file__) + "/../font/" + font
+FONT_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "font"))
+
+FONT_CACHE_SIZE = 32
+TEXT_CACHE_SIZE = 256
+QR_CACHE_SIZE = 128
+
+TITLE_FONT = "RobotoCondensed-Bold.ttf"
+MIN_FONT_SIZE = 8
+
+# print head resolution
+DPI = 180
+
+# qrcode.constants.ERROR_CORRECT_M, without importing qrcode
+ERROR_CORRECT_M = 0
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font : str, size : int):
+    fpath = os.path.join(FONT_DIR, font)
     log.debug(f"Load font from {fpath}")
-    font = ImageFont.truetype(fpath, size=size)
+    return ImageFont.truetype(fpath, size=size)
+
+
+def cache_info():
+    return {
+        "font": load_font.cache_info()._asdict(),
+        "text": rendertext.cache_info()._asdict(),
+        "metrics": text_width.cache_info()._asdict(),
+        "qr": qr_matrix.cache_info()._asdict(),
+        "qr_bitmap": qr_bitmap.cache_info()._asdict(),
+    }
+
+
+def cache_clear():
+    load_font.cache_clear()
+    rendertext.cache_clear()
+    text_width.cache_clear()
+    fit_text_size.cache_clear()
+    qr_matrix.cache_clear()
+    qr_bitmap.cache_clear()
+
+
+# Rendered text is cached and shared, callers must not modify the image
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+@timed("rendertext")
+def rendertext(text, size, font="RobotoCondensed-Bold.ttf"):
+    font = load_font(font, size)
     text_size = font.getsize(text)
     # print("Text dim: %d x %d" % text_size)
 
@@ -24,29 +69,107 @@ def rendertext(text, size, font="RobotoCondensed-Bold.ttf"):
     # img.show()
 
     # ImageFont.getsize is wrong a lot, so we have to crop
-    non_empty_rows = []
-    for y in range(img.height):
-        for x in range(img.width):
-            if img.getpixel((x, y)) == 0:
-                non_empty_rows += [y]
-                break
-    non_empty_columns = []
-    for x in range(img.width):
-        for y in range(img.height):
-            if img.getpixel((x, y)) == 0:
-                non_empty_columns += [x]
-                break
-
-    imageBox = (min(non_empty_columns), min(non_empty_rows), max(non_empty_columns)+1, max(non_empty_rows)+1)
+    imageBox = ImageChops.invert(img).getbbox()
     cropped = img.crop(imageBox)
     return cropped
 
 
+@lru_cache(maxsize=QR_CACHE_SIZE)
+@timed("qr")
+def qr_matrix(data : str, error_correction : int, mask_pattern : int = None):
+    # qrcode is slow to import, only load it once a QR code is needed
+    import qrcode
+
+    # without a mask pattern, all 8 are tried and the best one is used
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=error_correction,
+        box_size=1,
+        border=0,
+        mask_pattern=mask_pattern,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+
+def qr_best_mask(data : str, error_correction : int):
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, error_correction=error_correction, box_size=1, border=0)
+    qr.add_data(data)
+    qr.best_fit()
+    return qr.best_mask_pattern()
+
+
+# QR bitmaps are cached and shared, callers must not modify the image
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_bitmap(data : str, error_correction : int, height : int, mask_pattern : int = None):
+    matrix = qr_matrix(data, error_correction, mask_pattern)
+
+    # scale QR to fit label height
+    scale = height // len(matrix)
+    if scale == 0:
+        raise ValueError("QR code with %d modules does not fit in %dpx" % (len(matrix), height))
+
+    # expand each module to scale x scale pixels, black for dark modules
+    dark = b'\x00' * scale
+    light = b'\xff' * scale
+    rows = []
+    for row in matrix:
+        rows.append(b''.join(dark if m else light for m in row) * scale)
+    size = len(matrix) * scale
+    img = Image.frombytes("L", (size, size), b''.join(rows))
+    return img.convert("1", dither=Image.NONE)
+
+
+def mm_to_px(mm : float):
+    return math.floor(mm * DPI / 25.4)
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def text_width(text, size, font):
+    # Width from font metrics without rendering, never less than the cropped render
+    left, top, right, bottom = load_font(font, size).getbbox(text, mode="1")
+    return right - left
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def fit_text_size(title, subtitle, title_size, subtitle_size, subtitle_font, width):
+    # Find the largest title size, with the subtitle scaled along, that fits in width
+    def sizes(t):
+        return t, max(1, subtitle_size * t // title_size)
+
+    def fits(t):
+        t, s = sizes(t)
+        w = text_width(title, t, TITLE_FONT)
+        if subtitle:
+            w = max(w, text_width(subtitle, s, subtitle_font))
+        return w <= width
+
+    if fits(title_size):
+        return title_size, subtitle_size
+
+    lo, hi = min(MIN_FONT_SIZE, title_size), title_size - 1
+    if not fits(lo):
+        log.warning("Text does not fit in %dpx" % width)
+        return sizes(lo)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+    return sizes(lo)
+
+
 class Label:
-    def __init__(self, title : str, subtitle : str, id : str, qrdata : str, height : int = 128, title_ratio : float = 0.7):
+    def __init__(self, title : str, subtitle : str, id : str, qrdata : str, height : int = 128, title_ratio : float = 0.7,
+                 max_length : int = None):
         self.title = title
         self.subtitle = subtitle
         self.max_title_size = 120
+        self.base_title_ratio = title_ratio
         if self.subtitle:
             self.title_ratio = title_ratio
         else:
@@ -58,49 +181,120 @@ class Label:
         self.vspacing = 10
         self.padding = 10
         self.max_height = 128
+        self.qr_error_correction = ERROR_CORRECT_M
+        # None picks the best mask for each code, fixing it makes QR codes much faster to generate
+        self.qr_mask_pattern = None
+        # shrink the title and subtitle to fit the label in max_length px
+        self.max_length = max_length
 
-    def title_img(self):
-        font_size = self.max_title_size * self.title_ratio
-        return rendertext(self.title, math.floor(font_size * (self.height / self.max_height)), "RobotoCondensed-Bold.ttf")
+        # rendered components and the composed label, with the inputs they were made from
+        self.components = {}
+        self.rendered = (None, None)
 
-    def subtitle_img(self):
+    def update(self, **fields):
+        # Change label fields, components whose inputs are unchanged are not re-rendered
+        for name, value in fields.items():
+            if name == "title_ratio":
+                self.base_title_ratio = value
+            else:
+                setattr(self, name, value)
+        if self.subtitle:
+            self.title_ratio = self.base_title_ratio
+        else:
+            self.title_ratio = 1
+
+    def key(self):
+        # Everything that affects the rendered label
+        return (self.title, self.subtitle, self.id, self.qrdata, self.height, self.title_ratio,
+                self.max_title_size, self.max_height, self.hspacing, self.vspacing, self.padding,
+                self.qr_error_correction, self.qr_mask_pattern, self.max_length)
+
+    def component(self, name : str, key : tuple, func):
+        cached_key, img = self.components.get(name, (None, None))
+        if cached_key != key:
+            img = func()
+            self.components[name] = (key, img)
+        return img
+
+    def subtitle_font(self):
         font_size = self.max_title_size * (1 - self.title_ratio)
         if font_size >= 50:
-            return rendertext(self.subtitle, math.floor(font_size * (self.height / self.max_height)), "RobotoCondensed-Bold.ttf")
+            return "RobotoCondensed-Bold.ttf"
         else:
-            return rendertext(self.subtitle, math.floor(font_size * (self.height / self.max_height)), "RobotoCondensed-Regular.ttf")
+            return "RobotoCondensed-Regular.ttf"
 
-    def id_img(self):
-        img = rendertext(self.id, math.floor(24 * (self.height / self.max_height)), "Roboto-Regular.ttf")
-        rot = img.transpose(Image.ROTATE_90)
-        return rot
+    def font_sizes(self):
+        scale = self.height / self.max_height
+        title_size = math.floor(self.max_title_size * self.title_ratio * scale)
+        subtitle_size = math.floor(self.max_title_size * (1 - self.title_ratio) * scale)
+        if self.max_length is None:
+            return title_size, subtitle_size
 
-    def qr_img(self):
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_M,
-            box_size=1,
-            border=0,
-        )
-        qr.add_data(self.qrdata)
-        qr.make(fit=True)
+        width = self.max_length - self.fixed_width()
+        return fit_text_size(self.title, self.subtitle, title_size, subtitle_size, self.subtitle_font(), width)
+
+    def fixed_width(self):
+        # label width not taken by the title and subtitle
+        width = 2 * self.padding
+        if self.qrdata:
+            width += self.hspacing + self.qr_img().width
+        if self.id:
+            width += (self.vspacing if self.qrdata else self.hspacing) + self.id_img().width
+        return width
 
-        img = qr.make_image()
+    def title_img(self, size : int = None):
+        if size is None:
+            size = self.font_sizes()[0]
+        key = (self.title, size, TITLE_FONT)
+        return self.component("title", key, lambda: rendertext(*key))
 
-        # scale QR to fit label height
-        scale = self.height // img.size[1]
-        nimg = img.resize((img.size[0]*scale, img.size[1]*scale), resample=Image.NEAREST)
+    def subtitle_img(self, size : int = None):
+        if size is None:
+            size = self.font_sizes()[1]
+        key = (self.subtitle, size, self.subtitle_font())
+        return self.component("subtitle", key, lambda: rendertext(*key))
 
-        return nimg
+    def id_img(self):
+        key = (self.id, math.floor(24 * (self.height / self.max_height)), "Roboto-Regular.ttf")
+        return self.component("id", key, lambda: rendertext(*key).transpose(Image.ROTATE_90))
 
+    def qr_img(self):
+        key = (self.qrdata, self.qr_error_correction, self.height, self.qr_mask_pattern)
+        return self.component("qr", key, lambda: qr_bitmap(*key))
+
+    @timed("render")
     def render(self):
-        title = self.title_img()
+        # The composed label is shared between calls, callers must not modify it
+        title_size, subtitle_size = self.font_sizes()
+        title = self.title_img(title_size)
+        used = ["title"]
+        if self.subtitle:
+            self.subtitle_img(subtitle_size)
+            used.append("subtitle")
+        if self.qrdata:
+            self.qr_img()
+            used.append("qr")
+        if self.id:
+            self.id_img()
+            used.append("id")
+
+        key = (tuple((name, self.components[name][0]) for name in used),
+               self.height, self.hspacing, self.vspacing, self.padding)
+        if self.rendered[0] == key:
+            return self.rendered[1]
+        img = self.compose(title, subtitle_size)
+        self.rendered = (key, img)
+        return img
+
+    def layout(self, title : Image.Image, subtitle_size : int):
+        # Position of each component, the width of the title block and the total width.
+        # Columns left of the title block width only depend on the title and subtitle.
         title_x = self.padding
         subtitle_x = self.padding
         title_h = title.height
 
         if self.subtitle:
-            subtitle = self.subtitle_img()
+            subtitle = self.subtitle_img(subtitle_size)
             title_w = max(title.width, subtitle.width)
             title_x += (title_w // 2) - (title.width // 2)
             subtitle_x += (title_w // 2) - (subtitle.width // 2)
@@ -108,13 +302,19 @@ class Label:
         else:
             title_w = title.width
 
+        parts = [(title, title_x, (self.height - title_h) // 2)]
+        if self.subtitle:
+            parts.append((subtitle, subtitle_x, (self.height - title_h) // 2 + (title_h - subtitle.height)))
+
         qr_x = title_w + self.padding
+        block_w = qr_x
         qr_w = 0
 
         if self.qrdata:
             qr = self.qr_img()
             qr_x += self.hspacing
             qr_w = qr.width
+            parts.append((qr, qr_x, (self.height - qr.height) // 2))
 
         id_x = qr_x + qr_w
         id_w = 0
@@ -126,19 +326,16 @@ class Label:
             else:
                 id_x += self.vspacing
             id_w = id.width
+            parts.append((id, id_x, (self.height - id.height) // 2))
 
         total_w = id_x + id_w + self.padding
+        return parts, block_w, total_w
 
-        img = Image.new("1", (total_w, self.height), "white")
-        img.paste(title, (title_x, (self.height - title_h) // 2))
-
-        if self.subtitle:
-            img.paste(subtitle, (subtitle_x, (self.height - title_h) // 2 + (title_h - subtitle.height)))
-
-        if self.qrdata:
-            img.paste(qr, (qr_x, (self.height - qr.height) // 2))
+    def compose(self, title : Image.Image, subtitle_size : int):
+        parts, block_w, total_w = self.layout(title, subtitle_size)
 
-        if self.id:
-            img.paste(id, (id_x, (self.height - id.height) // 2))
+        img = Image.new("1", (total_w, self.height), "white")
+        for part, x, y in parts:
+            img.paste(part, (x, y))
 
         return img
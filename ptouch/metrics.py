@@ -0,0 +1,139 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Process wide totals, exported in the Prometheus text format
+_lock = threading.Lock()
+_stage_calls = {}
+_stage_seconds = {}
+_counters = {
+    "usb_writes": 0,
+    "usb_bytes": 0,
+    "jobs": 0,
+}
+
+# the job report collecting timings on this thread, if any
+_local = threading.local()
+
+
+class JobReport:
+    # Timings and USB traffic of one print job. Stages can nest, "encode" includes "rasterize".
+
+    def __init__(self, name : str = "job"):
+        self.name = name
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.stages = {}
+        self.usb_writes = 0
+        self.usb_bytes = 0
+
+    def add(self, stage : str, seconds : float):
+        calls, total = self.stages.get(stage, (0, 0.0))
+        self.stages[stage] = (calls + 1, total + seconds)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "elapsed": self.elapsed,
+            "stages": {stage: {"calls": calls, "seconds": seconds} for stage, (calls, seconds) in self.stages.items()},
+            "usb_writes": self.usb_writes,
+            "usb_bytes": self.usb_bytes,
+        }
+
+    def __str__(self):
+        stages = ", ".join("%s %.1fms" % (stage, seconds * 1000) for stage, (calls, seconds) in self.stages.items())
+        return "%s: %.1fms (%s), %d USB writes, %d bytes" % (
+            self.name, (self.elapsed or 0) * 1000, stages, self.usb_writes, self.usb_bytes)
+
+
+def current():
+    return getattr(_local, "report", None)
+
+
+@contextmanager
+def job(name : str = "job"):
+    # Collect the timings of everything done on this thread into a JobReport
+    report = JobReport(name)
+    previous = current()
+    _local.report = report
+    try:
+        yield report
+    finally:
+        _local.report = previous
+        report.elapsed = time.perf_counter() - report.start
+        with _lock:
+            _counters["jobs"] += 1
+        log.info("Job %s" % report)
+
+
+def record(stage : str, seconds : float):
+    with _lock:
+        _stage_calls[stage] = _stage_calls.get(stage, 0) + 1
+        _stage_seconds[stage] = _stage_seconds.get(stage, 0.0) + seconds
+    report = current()
+    if report is not None:
+        report.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage : str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record_write(length : int, seconds : float):
+    # One bulk transfer to the printer
+    record("usb_write", seconds)
+    with _lock:
+        _counters["usb_writes"] += 1
+        _counters["usb_bytes"] += length
+    report = current()
+    if report is not None:
+        report.usb_writes += 1
+        report.usb_bytes += length
+
+
+def snapshot():
+    with _lock:
+        return {
+            "stages": {stage: {"calls": _stage_calls[stage], "seconds": _stage_seconds[stage]} for stage in _stage_calls},
+            **_counters,
+        }
+
+
+def reset():
+    with _lock:
+        _stage_calls.clear()
+        _stage_seconds.clear()
+        for name in _counters:
+            _counters[name] = 0
+
+
+def prometheus_text():
+    # Counters in the Prometheus text exposition format
+    data = snapshot()
+    lines = [
+        "# HELP ptouch_stage_seconds_total Time spent in each stage of the print path.",
+        "# TYPE ptouch_stage_seconds_total counter",
+    ]
+    lines += ['ptouch_stage_seconds_total{stage="%s"} %f' % (stage, s["seconds"]) for stage, s in sorted(data["stages"].items())]
+    lines += [
+        "# HELP ptouch_stage_calls_total Number of times each stage ran.",
+        "# TYPE ptouch_stage_calls_total counter",
+    ]
+    lines += ['ptouch_stage_calls_total{stage="%s"} %d' % (stage, s["calls"]) for stage, s in sorted(data["stages"].items())]
+    for name, help in (("usb_writes", "USB bulk writes to the printer."),
+                       ("usb_bytes", "Bytes written to the printer."),
+                       ("jobs", "Print jobs finished.")):
+        lines += [
+            "# HELP ptouch_%s_total %s" % (name, help),
+            "# TYPE ptouch_%s_total counter" % name,
+            "ptouch_%s_total %d" % (name, data[name]),
+        ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,43 @@
+def encode(data : bytes) -> bytes:
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        # repeated run, up to 128 bytes
+        run = 1
+        while i + run < n and run < 128 and data[i + run] == data[i]:
+            run += 1
+        if run > 1:
+            out.append(257 - run)
+            out.append(data[i])
+            i += run
+            continue
+
+        # literal run, until the next run of 3 or more bytes
+        j = i + 1
+        while j < n and j - i < 128:
+            if j + 2 < n and data[j] == data[j + 1] == data[j + 2]:
+                break
+            j += 1
+        out.append(j - i - 1)
+        out += data[i:j]
+        i = j
+
+    return bytes(out)
+
+
+def decode(data : bytes) -> bytes:
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        if n < 128:
+            out += data[i + 1:i + 2 + n]
+            i += 2 + n
+        elif n > 128:
+            out += bytes([data[i + 1]]) * (257 - n)
+            i += 2
+        else:
+            # 0x80 is a no-op
+            i += 1
+    return bytes(out)
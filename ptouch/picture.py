@@ -0,0 +1,122 @@
+import hashlib
+import logging
+
+from PIL import Image, ImageOps, ImageChops
+
+from .metrics import timed
+
+log = logging.getLogger(__name__)
+
+FLOYD_STEINBERG = "floyd"
+ORDERED = "ordered"
+THRESHOLD = "threshold"
+DITHER_METHODS = (FLOYD_STEINBERG, ORDERED, THRESHOLD)
+
+# Thermal dots spread into their neighbours, lighten the midtones so photos do not print too dark
+GAMMA = 1.3
+
+# 4x4 Bayer matrix, at 180 dpi that is a 45 lpi screen, finer than 8x8 and still smooth
+_bayer = (
+    (0, 8, 2, 10),
+    (12, 4, 14, 6),
+    (3, 11, 1, 9),
+    (15, 7, 13, 5),
+)
+
+
+def flatten(img : Image.Image):
+    # Transparent areas print as white tape
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGBA", img.size, "white")
+        img = Image.alpha_composite(background, img)
+    return img.convert("L")
+
+
+def ordered_dither(img : Image.Image):
+    # Compare each pixel with a tiled threshold map, all done inside Pillow
+    width, height = img.size
+    rows = []
+    for row in _bayer:
+        line = bytes(int((v + 0.5) * 256 / 16) for v in row)
+        rows.append((line * (width // 4 + 1))[:width])
+    strip = b''.join(rows)
+    thresholds = Image.frombytes("L", (width, height), (strip * (height // 4 + 1))[:width * height])
+
+    # nonzero where the pixel is lighter than its threshold
+    lighter = ImageChops.subtract(img, thresholds)
+    return lighter.point([0] + [255] * 255, "1")
+
+
+def dither(img : Image.Image, method : str = FLOYD_STEINBERG):
+    if method == FLOYD_STEINBERG:
+        # Pillow's error diffusion runs in C
+        return img.convert("1")
+    if method == ORDERED:
+        return ordered_dither(img)
+    if method == THRESHOLD:
+        return img.point([0] * 128 + [255] * 128, "1")
+    raise ValueError("Unknown dither method: %s" % method)
+
+
+@timed("picture")
+def prepare(img : Image.Image, height : int, method : str = FLOYD_STEINBERG, gamma : float = GAMMA,
+            autocontrast : bool = True):
+    # Scale an image of any size to the tape height and dither it for printing
+    if img.format == "JPEG":
+        # decode large JPEGs at a reduced scale, much faster than a full decode.
+        # Both sides stay at least the tape height, whichever way the photo is turned below.
+        img.draft("L", (height, height))
+    # photos from phones are stored sideways with an EXIF orientation tag
+    img = ImageOps.exif_transpose(img)
+    width = max(1, round(img.width * height / img.height))
+    img = flatten(img)
+    img = img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+
+    if autocontrast:
+        img = ImageOps.autocontrast(img, cutoff=1)
+    if gamma != 1:
+        img = img.point([round(255 * (i / 255) ** (1 / gamma)) for i in range(256)])
+    return dither(img, method)
+
+
+def load(path : str, height : int):
+    if path.lower().endswith(".svg"):
+        # SVG support is optional, render straight at the tape height
+        import io
+        try:
+            import cairosvg
+        except ImportError:
+            raise Exception("SVG images need cairosvg, install it with: pip install cairosvg")
+        return Image.open(io.BytesIO(cairosvg.svg2png(url=path, output_height=height)))
+    return Image.open(path)
+
+
+class Picture:
+    # Image or logo file printed at tape height, works with RasterCache like a Label
+
+    def __init__(self, path : str, height : int = 128, method : str = FLOYD_STEINBERG, gamma : float = GAMMA,
+                 autocontrast : bool = True, padding : int = 20):
+        self.path = path
+        self.height = height
+        self.method = method
+        self.gamma = gamma
+        self.autocontrast = autocontrast
+        self.padding = padding
+        self.digest = None
+        self.rendered = None
+
+    def key(self):
+        # The file contents, not its name, so edited files are not served from the cache
+        if self.digest is None:
+            with open(self.path, "rb") as f:
+                self.digest = hashlib.sha256(f.read()).hexdigest()
+        return ("picture", self.digest, self.height, self.method, self.gamma, self.autocontrast, self.padding)
+
+    def render(self):
+        if self.rendered is None:
+            with load(self.path, self.height) as img:
+                picture = prepare(img, self.height, self.method, self.gamma, self.autocontrast)
+            self.rendered = Image.new("1", (picture.width + 2 * self.padding, self.height), "white")
+            self.rendered.paste(picture, (self.padding, 0))
+        return self.rendered
@@ -0,0 +1,54 @@
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .label import Label
+from .batch import make_labels
+from .ptd600 import PTD600, RasterEncoder
+
+log = logging.getLogger(__name__)
+
+# labels rendered ahead of the transmit stage
+QUEUE_SIZE = 16
+
+
+def render_label(label : dict, height : int, label_kwargs : dict):
+    return Label(label["title"], label["subtitle"], label["id"], label["qr"], height=height, **label_kwargs).render()
+
+
+def encode_label(label : dict, encoder : RasterEncoder, compress : bool, label_kwargs : dict):
+    # Runs in a worker process, every label is built as a chained page
+    img = render_label(label, encoder.tape_px, label_kwargs)
+    return encoder.build_job(img, compress, last=False)
+
+
+def ordered(pool, func, items, args, queue_size : int = QUEUE_SIZE):
+    # Submit items to the pool, keeping at most queue_size in flight, and yield results in order
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item, *args))
+        if len(pending) >= queue_size:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def render_parallel(labels, height : int, workers : int = None, queue_size : int = QUEUE_SIZE, **label_kwargs):
+    with ProcessPoolExecutor(workers) as pool:
+        yield from ordered(pool, render_label, labels, (height, label_kwargs), queue_size)
+
+
+def encode_parallel(encoder : RasterEncoder, labels, compress : bool = True, workers : int = None,
+                    queue_size : int = QUEUE_SIZE, **label_kwargs):
+    # Yields the (job, stats) of each label in order, as chained pages for PrintJob
+    with ProcessPoolExecutor(workers) as pool:
+        yield from ordered(pool, encode_label, labels, (encoder, compress, label_kwargs), queue_size)
+
+
+def print_pipelined(ptouch : PTD600, labels, compress : bool = True, workers : int = None,
+                    queue_size : int = QUEUE_SIZE, **label_kwargs):
+    # Render and encode in a process pool while this thread transmits finished labels in order.
+    # Returns the job_stats of each label once all are printed, like PTD600.print_batch.
+    labels = list(labels)
+    jobs = encode_parallel(ptouch.encoder(), labels, compress, workers, queue_size, **label_kwargs)
+    return ptouch.print_batch(make_labels(labels, ptouch.tape_px, **label_kwargs), compress, jobs)
@@ -0,0 +1,123 @@
+import logging
+import threading
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from .ptd600 import PTD600, find_printers
+
+log = logging.getLogger(__name__)
+
+
+class PrinterPool:
+    # Routes labels to printers loaded with matching tape, one thread per printer
+
+    def __init__(self, printers):
+        self.printers = list(printers)
+        self.locks = {id(ptouch): threading.Lock() for ptouch in self.printers}
+        # signalled whenever a printer becomes idle
+        self.idle = threading.Condition()
+
+    @classmethod
+    @contextmanager
+    def open(cls, **kwargs):
+        # Opens every connected PTD600 that is accessible
+        import usb1
+
+        with usb1.USBContext() as context, ExitStack() as stack:
+            printers = []
+            for pid, device in find_printers(context):
+                try:
+                    ptouch = stack.enter_context(PTD600.claim(device.open(), **kwargs))
+                except Exception as e:
+                    log.warning("Skipping PTD600 %s: %s" % (pid, e))
+                    continue
+                ptouch.id = pid
+                log.info("Opened PTD600 %s, tape %dmm" % (pid, ptouch.status.media_width))
+                printers.append(ptouch)
+
+            if not printers:
+                raise Exception("Failed to open any PTD600")
+            yield cls(printers)
+
+    def widths(self):
+        # Loaded tape widths in mm, with the number of printers for each
+        widths = {}
+        for ptouch in self.printers:
+            widths[ptouch.status.media_width] = widths.get(ptouch.status.media_width, 0) + 1
+        return widths
+
+    def matching(self, tape_px : int):
+        return [ptouch for ptouch in self.printers if ptouch.tape_px == tape_px]
+
+    def refresh(self):
+        # Re-read the tape of idle printers, in case the cassette was swapped
+        for ptouch in self.printers:
+            with self.idle:
+                if not self.locks[id(ptouch)].acquire(blocking=False):
+                    continue
+            try:
+                ptouch.getstatus()
+            finally:
+                # wakes threads that found the printer busy while it was refreshed
+                self.release(ptouch)
+
+    def acquire(self, tape_px : int, timeout : float = None):
+        # Waits for an idle printer with tape_px tape and locks it
+        if not self.matching(tape_px):
+            raise Exception("No printer loaded with %dpx tape, have %s" %
+                            (tape_px, ", ".join("%dmm" % w for w in sorted(self.widths()))))
+        with self.idle:
+            while True:
+                for ptouch in self.matching(tape_px):
+                    if self.locks[id(ptouch)].acquire(blocking=False):
+                        return ptouch
+                if not self.idle.wait(timeout):
+                    raise Exception("Timeout waiting for a printer with %dpx tape" % tape_px)
+
+    def release(self, ptouch : PTD600):
+        with self.idle:
+            self.locks[id(ptouch)].release()
+            self.idle.notify_all()
+
+    @contextmanager
+    def printer(self, tape_px : int, timeout : float = None):
+        ptouch = self.acquire(tape_px, timeout)
+        try:
+            yield ptouch
+        finally:
+            self.release(ptouch)
+
+    def print_img(self, img : Image.Image, compress : bool = True):
+        with self.printer(img.height) as ptouch:
+            return ptouch.print_img(img, compress)
+
+    def print_batch(self, images, compress : bool = True):
+        # Labels of the same height are split into consecutive runs, one per matching printer.
+        # Returns stats in the order of images.
+        images = list(images)
+        self.refresh()
+        groups = {}
+        for i, img in enumerate(images):
+            groups.setdefault(img.height, []).append(i)
+
+        runs = []
+        for tape_px, indices in groups.items():
+            count = max(len(self.matching(tape_px)), 1)
+            size = -(-len(indices) // count)
+            runs += [(tape_px, indices[i:i + size]) for i in range(0, len(indices), size)]
+
+        def print_run(run):
+            tape_px, indices = run
+            with self.printer(tape_px) as ptouch:
+                log.info("Printing %d labels on %s" % (len(indices), getattr(ptouch, "id", "PTD600")))
+                stats = ptouch.print_batch([images[i] for i in indices], compress)
+            return indices, stats
+
+        results = [None] * len(images)
+        with ThreadPoolExecutor(max_workers=len(self.printers)) as executor:
+            for indices, stats in executor.map(print_run, runs):
+                for i, st in zip(indices, stats):
+                    results[i] = st
+        return results
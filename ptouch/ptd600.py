@@ -5,11 +5,15 @@ import logging
 from typing import NamedTuple
 from contextlib import contextmanager
 
-import usb1
 from PIL import Image
 
+from . import packbits
+from .metrics import timed, record_write
+
 log = logging.getLogger(__name__)
 
+# usb1 is imported where the device is used, encoding labels does not need it
+
 tape_sizes = {
     6:  (32, 48+6),
     9:  (52, 38+6),
@@ -18,6 +22,61 @@ tape_sizes = {
     24: (128, 0),
 }
 
+_invert = bytes(0xff - i for i in range(256))
+
+# error info 1 in the low byte, error info 2 in the high byte
+status_errors = {
+    0x0001: "No media",
+    0x0004: "Cutter jam",
+    0x0008: "Weak batteries",
+    0x0040: "High-voltage adapter",
+    0x0100: "Replace media",
+    0x1000: "Cover open",
+    0x2000: "Overheating",
+}
+
+STATUS_REPLY = 0x00
+STATUS_PRINTED = 0x01
+STATUS_ERROR = 0x02
+STATUS_OFF = 0x04
+STATUS_NOTIFICATION = 0x05
+STATUS_PHASE = 0x06
+
+status_types = {
+    STATUS_REPLY: "Reply to status request",
+    STATUS_PRINTED: "Printing completed",
+    STATUS_ERROR: "Error occurred",
+    STATUS_OFF: "Turned off",
+    STATUS_NOTIFICATION: "Notification",
+    STATUS_PHASE: "Phase change",
+}
+
+PHASE_EDITING = 0x00
+PHASE_PRINTING = 0x01
+
+phase_types = {
+    PHASE_EDITING: "Editing",
+    PHASE_PRINTING: "Printing",
+}
+
+notifications = {
+    0x00: "Not available",
+    0x01: "Cover open",
+    0x02: "Cover closed",
+}
+
+
+# ESC i M various mode bits
+AUTO_CUT = 0x40
+# ESC i K advanced mode bits
+NO_CHAIN = 0x08
+
+
+def set_last(job : bytes, last : bool):
+    # Swap a job between the last label of a run and a chained label,
+    # only the auto cut mode at the start of the header and the final print command differ
+    return job[:3] + bytes([AUTO_CUT if last else 0]) + job[4:-1] + (b'\x1a' if last else b'\x0c')
+
 
 class ptouch_status(NamedTuple):
     printheadmark: int  # 0x80
@@ -45,55 +104,382 @@ class ptouch_status(NamedTuple):
     text_color: int     # table 9
     hw_setting: int
 
+    @property
+    def errors(self):
+        return [name for bit, name in status_errors.items() if self.error & bit]
+
+    @property
+    def status_name(self):
+        return status_types.get(self.status_type, "Unknown (0x%02x)" % self.status_type)
+
+    @property
+    def phase_name(self):
+        return phase_types.get(self.phase_type, "Unknown (0x%02x)" % self.phase_type)
+
+    @property
+    def notif_name(self):
+        return notifications.get(self.notif_number, "Unknown (0x%02x)" % self.notif_number)
+
+
+def parse_status(buf : bytes):
+    assert buf[0] == 0x80 and buf[1] == 0x20
+    return ptouch_status(*struct.unpack("BBBBBBHHBBBBBBBBBBHBBBBI", buf))
+
+
+class PrinterError(Exception):
+    def __init__(self, status : ptouch_status):
+        super().__init__(", ".join(status.errors) or status.status_name)
+        self.status = status
+
+
+class job_stats(NamedTuple):
+    lines: int
+    blank_lines: int
+    raw_bytes: int      # uncompressed raster commands
+    sent_bytes: int
+
+    @property
+    def ratio(self):
+        return self.sent_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+
+class RasterEncoder:
+    # Builds printer command streams, no device needed
+
+    def __init__(self, tape_px : int = 0, tape_offset : int = 0, max_px : int = 128):
+        self.max_px = max_px
+        self.tape_px = tape_px
+        self.tape_offset = tape_offset
+
+    @timed("rasterize")
+    def make_raster(self, img : Image.Image):
+        assert img.height == self.tape_px
+        assert img.mode == "1"
+
+        # Transpose so each label column becomes one packed row, shifted down
+        # by the tape offset inside the full print head width
+        col = Image.new("1", (self.max_px, img.width), "white")
+        col.paste(img.transpose(Image.TRANSPOSE), (self.tape_offset, 0))
+
+        # Mode "1" packs MSB first with white as 1, the printer wants black as 1
+        return col.tobytes().translate(_invert)
+
+    def make_rasterlines(self, img : Image.Image):
+        raster = self.make_raster(img)
+        line_len = self.max_px // 8
+        for i in range(0, len(raster), line_len):
+            yield raster[i:i+line_len]
+
+    @timed("encode")
+    def encode_raster(self, img : Image.Image, compress : bool = True):
+        cmds = []
+        blank = 0
+        sent = 0
+        lines = 0
+        for rasterline in self.make_rasterlines(img):
+            lines += 1
+            if not any(rasterline):
+                # 5A = zero raster line
+                cmd = b'\x5a'
+                blank += 1
+            elif compress:
+                data = packbits.encode(rasterline)
+                # 47 n1 n2 = send raster line, n = data length
+                cmd = b'\x47' + struct.pack("<H", len(data)) + data
+            else:
+                cmd = b'\x47' + struct.pack("<H", len(rasterline)) + rasterline
+            sent += len(cmd)
+            cmds.append(cmd)
+
+        raw = lines * (3 + self.max_px // 8)
+        stats = job_stats(lines, blank, raw, sent)
+        return cmds, stats
+
+    def job_header(self, compress : bool = True, last : bool = True):
+        # Cutting is set for every job, not left to the printer's stored settings.
+        # 1B 69 4D n = ESC i M = Various mode, auto cut only after the last label of a run, see set_last
+        # 1B 69 41 01 = ESC i A = Cut every label that has auto cut on
+        # 1B 69 4B 08 = ESC i K = Advanced mode, no chain printing, the last label is fed out and cut
+        # 4D 00 = disable compression
+        # 4D 02 = enable packbits compression mode
+        # 1B 69 52 01 = ESC i R 01 = Select graphics transfer mode = Raster
+        return (b'\x1biM' + bytes([AUTO_CUT if last else 0]) + b'\x1biA\x01' + b'\x1biK' + bytes([NO_CHAIN]) +
+                (b'M\x02' if compress else b'M\x00') + b'\x1biR\x01')
+
+    def build_job(self, img : Image.Image, compress : bool = True, last : bool = True):
+        assert img.height == self.tape_px
+        assert img.mode == "1"
+
+        cmds, stats = self.encode_raster(img, compress)
 
-class PTD600:
+        job = [self.job_header(compress, last)]
+        job += cmds
+
+        # 1A = eject and cut tape
+        # 0C = print page without cutting, for chained labels
+        job.append(b'\x1a' if last else b'\x0c')
+
+        return b''.join(job), stats
+
+    def stream_job(self, chunks, compress : bool = True, last : bool = True):
+        # Yields the command stream of one label piece by piece, one piece per chunk of columns.
+        # The stats of the whole label are returned when the generator is exhausted.
+        yield self.job_header(compress, last)
+        total = job_stats(0, 0, 0, 0)
+        for chunk in chunks:
+            cmds, stats = self.encode_raster(chunk, compress)
+            total = job_stats(*(a + b for a, b in zip(total, stats)))
+            yield b''.join(cmds)
+        yield b'\x1a' if last else b'\x0c'
+        return total
+
+    def log_stats(self, stats : job_stats):
+        log.info("Raster: %d lines (%d blank), %d -> %d bytes, ratio %.2f" %
+                 (stats.lines, stats.blank_lines, stats.raw_bytes, stats.sent_bytes, stats.ratio))
+
+    def encoder(self):
+        # Snapshot of the current tape geometry, can be passed to other processes
+        return RasterEncoder(self.tape_px, self.tape_offset, self.max_px)
+
+    def decode_status(self, buf : bytes):
+        # Parse a status block read from the printer and follow the tape it reports
+        status = parse_status(buf)
+        log.debug("Status: %s, phase %s, errors %s" % (status.status_name, status.phase_name, status.errors))
+        self.tape_px, self.tape_offset = tape_sizes.get(status.media_width, (0, 0))
+        return status
+
+
+def wait_printed(pages : int, timeout : int, status_timeout : int):
+    # Waits for the printing completed status of each page as driver calls, see PTD600.drive.
+    # Raises if the printer reports an error or turns off, or a page takes longer than timeout ms.
+    deadline = time.monotonic() + timeout / 1000 if timeout else None
+    while True:
+        wait = status_timeout
+        if deadline is not None:
+            wait = int((deadline - time.monotonic()) * 1000)
+            if wait <= 0:
+                raise Exception("Timeout waiting for PTD600 to print")
+        status = yield ("read_status", wait)
+        if status is None:
+            continue
+        if status.status_type in (STATUS_ERROR, STATUS_OFF):
+            raise PrinterError(status)
+        if status.status_type == STATUS_PRINTED:
+            pages -= 1
+            if pages <= 0:
+                return status
+            if deadline is not None:
+                deadline = time.monotonic() + timeout / 1000
+        if status.status_type == STATUS_NOTIFICATION:
+            log.info("Notification: %s" % status.notif_name)
+
+
+class printer_id(NamedTuple):
+    bus: int
+    address: int
+    serial: str
+
+    def __str__(self):
+        return "%03d:%03d %s" % (self.bus, self.address, self.serial or "(no serial)")
+
+
+def open_handle(context : "usb1.USBContext", serial : str = None, bus : int = None, address : int = None):
+    # Opens the first PTD600, or the one matching the given serial number or bus and address
+    if serial is None and bus is None and address is None:
+        handle = context.openByVendorIDAndProductID(PTD600.VID, PTD600.PID)
+    else:
+        handle = None
+        for id, device in find_printers(context):
+            if ((serial is None or id.serial == serial) and (bus is None or id.bus == bus) and
+                    (address is None or id.address == address)):
+                handle = device.open()
+                break
+    if handle is None:
+        # Device not present, or user is not allowed to access device.
+        raise Exception("Failed to open PTD600")
+    return handle
+
+
+def find_printers(context : "usb1.USBContext"):
+    # Yields (printer_id, usb1.USBDevice) for every connected PTD600
+    import usb1
+
+    for device in context.getDeviceIterator(skip_on_error=True):
+        if device.getVendorID() != PTD600.VID or device.getProductID() != PTD600.PID:
+            continue
+        try:
+            serial = device.getSerialNumber()
+        except usb1.USBError:
+            # reading the serial needs access to the device
+            serial = ""
+        yield printer_id(device.getBusNumber(), device.getDeviceAddress(), serial or ""), device
+
+
+class PTD600(RasterEncoder):
     VID = 0x04f9
     PID = 0x2074
     INTF = 0
     SEND_EP = 0x02
     RECV_EP = 0x81
 
-    def __init__(self, handle : usb1.USBDeviceHandle):
+    CHUNK_SIZE = 16384
+    MIN_CHUNK_SIZE = 64
+    WRITE_TIMEOUT = 5000
+    STATUS_TIMEOUT = 1000
+    # ms to wait for each page to print, about 3.5 m of tape
+    PRINT_TIMEOUT = 120000
+
+    def __init__(self, handle : "usb1.USBDeviceHandle", chunk_size : int = CHUNK_SIZE):
+        super().__init__()
         self.handle = handle
+        self.chunk_size = chunk_size
         self.status = None
-        self.max_px = 128
-        self.tape_px = 0
-        self.tape_offset = 0
+        # last print job, resume it after a PrinterError
+        self.job = None
 
         self.init()
         self.getstatus()
 
     @classmethod
     @contextmanager
-    def open(cls):
+    def open(cls, serial : str = None, bus : int = None, address : int = None, **kwargs):
+        # Opens the first PTD600, or the one matching the given serial number or bus and address
+        import usb1
+
         with usb1.USBContext() as context:
-            handle = context.openByVendorIDAndProductID(PTD600.VID, PTD600.PID)
-            if handle is None:
-                # Device not present, or user is not allowed to access device.
-                raise Exception("Failed to open PTD600")
+            with cls.claim(open_handle(context, serial, bus, address), **kwargs) as ptouch:
+                yield ptouch
 
-            try:
-                handle.detachKernelDriver(PTD600.INTF)
-            except:
-                pass
+    @classmethod
+    @contextmanager
+    def claim(cls, handle : "usb1.USBDeviceHandle", **kwargs):
+        try:
+            handle.detachKernelDriver(PTD600.INTF)
+        except:
+            pass
 
+        try:
             with handle.claimInterface(PTD600.INTF):
-                yield PTD600(handle)
+                yield cls(handle, **kwargs)
+        finally:
+            handle.close()
 
     def init(self):
         cmd = b'\x1b\x40' # 1B 40 = ESC @ = INIT
         self.handle.bulkWrite(self.SEND_EP, cmd)
 
+    def reset(self):
+        # 100 x 00 = invalidate, ends any raster data left over from an interrupted job
+        self.handle.bulkWrite(self.SEND_EP, bytes(100), timeout=self.WRITE_TIMEOUT)
+        self.init()
+
+    def send(self, data : bytes, chunk_size : int = None):
+        # A reduced chunk size only lasts for this job, it is returned so a job sent in pieces can continue with it
+        import usb1
+
+        chunk_size = chunk_size or self.chunk_size
+        pos = 0
+        while pos < len(data):
+            chunk = data[pos:pos + chunk_size]
+            start = time.perf_counter()
+            try:
+                written = self.handle.bulkWrite(self.SEND_EP, chunk, timeout=self.WRITE_TIMEOUT)
+                record_write(written, time.perf_counter() - start)
+                pos += written
+            except usb1.USBErrorTimeout as e:
+                record_write(e.transferred, time.perf_counter() - start)
+                # Printer input buffer is full, continue with smaller transfers
+                pos += e.transferred
+                # only give up when the smallest transfers make no progress at all
+                if e.transferred == 0 and chunk_size <= self.MIN_CHUNK_SIZE:
+                    raise
+                chunk_size = max(chunk_size // 2, self.MIN_CHUNK_SIZE)
+                log.warning("Write timeout, reduced chunk size to %d" % chunk_size)
+        return chunk_size
+
+    def read_status(self, timeout : int = STATUS_TIMEOUT):
+        # Block until the printer sends a status block, or return None on timeout
+        import usb1
+
+        deadline = time.monotonic() + timeout / 1000
+        while True:
+            remaining = int((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                return None
+            try:
+                buf = self.handle.bulkRead(self.RECV_EP, 32, timeout=remaining)
+            except usb1.USBErrorTimeout:
+                return None
+            # the printer answers with empty reads until a status is ready
+            if len(buf) == 32:
+                break
+            time.sleep(0.01)
+
+        # print(buf.hex())
+        self.status = self.decode_status(buf)
+        return self.status
+
     def getstatus(self):
         # 1B 69 53 = ESC i S = Status info request
         self.handle.bulkWrite(self.SEND_EP, b'\x1biS')
-        time.sleep(0.1)
-        buf = self.handle.bulkRead(self.RECV_EP, 32)
-        assert len(buf) == 32
-        # print(buf.hex())
-        assert buf[0] == 0x80 and buf[1] == 0x20
-        self.status = ptouch_status(*struct.unpack("BBBBBBHHBBBBBBBBBBHBBBBI", buf))
-        self.tape_px, self.tape_offset = tape_sizes[self.status.media_width]
+        while True:
+            status = self.read_status()
+            if status is None:
+                raise Exception("No status reply from PTD600")
+            # skip notifications left over from earlier jobs
+            if status.status_type == STATUS_REPLY:
+                return status
+
+    def drive(self, steps):
+        # Runs a generator of driver calls, the logic shared with AsyncPTD600.drive.
+        # Each step is a (method name, args..) tuple, the result is sent back and USB errors are thrown in.
+        import usb1
+
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    result = getattr(self, call[0])(*call[1:])
+                except usb1.USBError as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    @timed("wait")
+    def wait_until_printed(self, pages : int = 1, timeout : int = PRINT_TIMEOUT):
+        # Wait for the printing completed status of each page, raise if the printer reports an error.
+        # timeout applies to each page, None waits forever.
+        return self.drive(wait_printed(pages, timeout, self.STATUS_TIMEOUT))
+
+    def print_stream(self, chunks, compress : bool = True, last : bool = True, wait : bool = True):
+        # Send each chunk as soon as it is encoded, for labels too long to render at once
+        stream = self.stream_job(chunks, compress, last)
+        chunk_size = None
+        while True:
+            try:
+                data = next(stream)
+            except StopIteration as e:
+                stats = e.value
+                break
+            chunk_size = self.send(data, chunk_size)
+
+        self.log_stats(stats)
+        if wait:
+            self.wait_until_printed()
+        return stats
+
+    def wait_until_ready(self, timeout : int = None, interval : float = 0.5):
+        # Poll until the printer reports no errors, e.g. after the cover was closed or tape replaced
+        deadline = time.monotonic() + timeout / 1000 if timeout else None
+        while True:
+            status = self.getstatus()
+            if not status.error:
+                return status
+            if deadline is not None and time.monotonic() > deadline:
+                raise PrinterError(status)
+            time.sleep(interval)
 
     def log_info(self):
         log.info("Tape: %dmm, %dpx" % (self.status.media_width, self.tape_px))
@@ -102,73 +488,30 @@ class PTD600:
             8: "Black",
         }
         log.info("Color: %d, %d" % (self.status.tape_color, self.status.text_color))
+        if self.status.error:
+            log.warning("Errors: %s" % ", ".join(self.status.errors))
 
-    def make_rasterlines(self, img : Image):
-        assert img.height == self.tape_px
-        assert img.mode == "1"
-
-
-        for x in range(img.width):
-            rasterline = bytearray([0x00] * (self.max_px // 8))
-
-            # pack pixels into raster bits
-            for y in range(img.height):
-                # val = img.getpixel((x, img.height - 1 - y))
-                # if val == 0:
-                #     rasterline[(len(rasterline)-1) - (y//8)] |= (1 << (y%8))
-
-                val = img.getpixel((x, y))
-                sy = y + self.tape_offset
-                if val == 0:
-                    rasterline[(sy//8)] |= (1 << (7-(sy%8)))
-
-            yield bytes(rasterline)
-
-    def print_img(self, img : Image.Image):
-        assert img.height == self.tape_px
-        assert img.mode == "1"
-
-        # 4D 00 = disable compression
-        # 4D 02 = enable packbits compression mode
-        self.handle.bulkWrite(self.SEND_EP, b'M\x02')
-
-        # 1B 69 52 01 = ESC i R 01 = Select graphics transfer mode = Raster
-        self.handle.bulkWrite(self.SEND_EP, b'\x1biR\x01')
+    def print_img(self, img : Image.Image, compress : bool = True):
+        return self.print_batch([img], compress)[0]
 
-        for rasterline in self.make_rasterlines(img):
-            # 47 = send raster line
-            cmd = b'\x47' + bytes([len(rasterline) + 1, 0x00, len(rasterline) - 1]) + rasterline
-            self.handle.bulkWrite(self.SEND_EP, cmd)
+    def print_batch(self, images, compress : bool = True, jobs = None):
+        # Print all labels in one session, only cutting after the last one, and wait until they are printed.
+        # See PrintJob for images and jobs.
+        from .resume import PrintJob
 
-        # 1A = eject and cut tape
-        self.handle.bulkWrite(self.SEND_EP, b'\x1a')
+        self.job = PrintJob(images, compress, jobs)
+        return self.job.run(self)
 
 
 if __name__ == "__main__":
-    # img = Image.open("test_76.png")
-    img = Image.open("test_128.png")
-    img = img.convert("1")
-    # img.show()
+    import sys
+    from .picture import Picture
 
-    pimg = Image.new("1", (img.width + 40, img.height), "white")
-    pimg.paste(img, (20, 0))
-
-    with usb1.USBContext() as context:
-        handle = context.openByVendorIDAndProductID(PTD600.VID, PTD600.PID)
-        if handle is None:
-            # Device not present, or user is not allowed to access device.
-            print("Unable to open PTD600")
-        else:
-            try:
-                handle.detachKernelDriver(PTD600.INTF)
-            except:
-                pass
-
-            with handle.claimInterface(PTD600.INTF):
-                # Do stuff with endpoints on claimed interface.
-                print("Opened PTD600")
+    # any image file, scaled and dithered to the loaded tape
+    path = sys.argv[1] if len(sys.argv) > 1 else "test_128.png"
 
-                ptouch = PTD600(handle)
-                ptouch.log_info()
+    with PTD600.open() as ptouch:
+        print("Opened PTD600")
+        ptouch.log_info()
 
-                ptouch.print_img(pimg)
+        ptouch.print_img(Picture(path, height=ptouch.tape_px).render())
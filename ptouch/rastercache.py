@@ -0,0 +1,91 @@
+import os
+import json
+import struct
+import hashlib
+import logging
+import tempfile
+
+from .label import Label
+from .ptd600 import RasterEncoder, job_stats, set_last
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ptouch", "raster")
+MAX_SIZE = 64 * 1024 * 1024
+
+# bump when rendering or encoding changes, so old entries are not reused
+VERSION = 2
+
+# job_stats stored in front of the command stream
+_header = struct.Struct("<IIII")
+
+
+class RasterCache:
+    # On-disk cache of encoded print jobs, keyed by everything that goes into them
+
+    def __init__(self, path : str = CACHE_DIR, max_size : int = MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, label : Label, encoder : RasterEncoder, compress : bool):
+        fields = [VERSION, label.key(), encoder.tape_px, encoder.tape_offset, encoder.max_px, compress]
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+    def get(self, key : str):
+        fpath = os.path.join(self.path, key)
+        try:
+            with open(fpath, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # mark as recently used for eviction
+        os.utime(fpath)
+        stats = job_stats(*_header.unpack_from(data))
+        return data[_header.size:], stats
+
+    def put(self, key : str, job : bytes, stats : job_stats):
+        # write to a temporary file first, so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(_header.pack(*stats))
+            f.write(job)
+        os.replace(tmp, os.path.join(self.path, key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith("."):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        # remove least recently used entries until under max_size
+        entries.sort()
+        for mtime, size, fpath in entries:
+            if total <= self.max_size:
+                break
+            os.unlink(fpath)
+            total -= size
+
+    def build_job(self, encoder : RasterEncoder, label : Label, compress : bool = True, last : bool = True):
+        key = self.key(label, encoder, compress)
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            job, stats = cached
+        else:
+            self.misses += 1
+            job, stats = encoder.build_job(label.render(), compress)
+            self.put(key, job, stats)
+        return set_last(job, last), stats
+
+    def build_jobs(self, encoder : RasterEncoder, labels, compress : bool = True):
+        # Yields (job, stats) for each label, only the last one ends with a cut
+        labels = list(labels)
+        for i, label in enumerate(labels):
+            yield self.build_job(encoder, label, compress, last=(i == len(labels) - 1))
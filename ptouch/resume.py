@@ -0,0 +1,177 @@
+import time
+import logging
+
+from PIL import Image
+
+from .metrics import timed
+from .ptd600 import PTD600, RasterEncoder, PrinterError, set_last, STATUS_PRINTED, STATUS_ERROR, STATUS_OFF, \
+    STATUS_PHASE, STATUS_NOTIFICATION, PHASE_PRINTING
+
+log = logging.getLogger(__name__)
+
+# PT-D600 print speed is 30 mm/s, in raster lines at 180 dpi
+LINES_PER_SECOND = 30 * 180 / 25.4
+
+# labels shorter than this are printed again from the start
+LONG_LABEL = 720
+# lines held back from the printed estimate, better to repeat a little than to leave a gap
+SAFETY_LINES = 90
+
+# ms to wait for a fault to be cleared before resuming
+READY_TIMEOUT = 60000
+
+
+class PrintJob:
+    # Batch of labels that keeps track of what the printer reported as printed,
+    # so the rest can be printed after a fault without starting over.
+
+    # ms to wait for status blocks after sending each label
+    POLL_TIMEOUT = 10
+
+    def __init__(self, images, compress : bool = True, jobs = None):
+        # images are PIL images, or labels rendered when needed like Label and Picture.
+        # jobs optionally yields the encoded (job, stats) of each label in order, e.g. from the raster cache,
+        # then labels are only rendered to resume a long label part way.
+        self.images = list(images)
+        self.compress = compress
+        self.jobs = iter(jobs) if jobs is not None else None
+        # encoded labels taken from jobs, until they are printed
+        self.encoded = {}
+        self.taken = 0
+        # labels the printer reported as printed
+        self.printed = 0
+        # raster line the next label restarts from, for a long label that was cut short
+        self.offset = 0
+        # when the printer started on the current label
+        self.started = None
+        # stats of the last attempt at each label
+        self.stats = [None] * len(self.images)
+        self.error = None
+
+    @property
+    def done(self):
+        return self.printed >= len(self.images)
+
+    def run(self, ptouch : PTD600):
+        # Print what is left of the job, on a printer fault PrinterError is raised and the progress kept
+        return ptouch.drive(self.steps(ptouch))
+
+    def steps(self, ptouch : PTD600, wait : bool = True):
+        # The job as driver calls, run by PTD600.drive and AsyncPTD600.drive
+        import usb1
+
+        self.started = None
+        try:
+            for i in range(self.printed, len(self.images)):
+                job, stats = self.build_job(ptouch, i)
+                yield ("send", job)
+                ptouch.log_stats(stats)
+                self.stats[i] = stats
+                yield from self.poll(self.POLL_TIMEOUT)
+
+            if wait:
+                with timed("wait"):
+                    yield from self.wait(ptouch)
+
+        except usb1.USBError as e:
+            # the printer stopped taking data, ask it why
+            log.warning("Transfer failed: %s" % e)
+            yield from self.poll(self.POLL_TIMEOUT)
+            self.check((yield ("getstatus",)))
+            raise
+
+        return self.stats
+
+    def resume(self, ptouch : PTD600, timeout : int = READY_TIMEOUT):
+        # Wait for the fault to be cleared, then print the rest of the job
+        return ptouch.drive(self.resume_steps(ptouch, timeout))
+
+    def resume_steps(self, ptouch : PTD600, timeout : int = READY_TIMEOUT, wait : bool = True):
+        # resume as driver calls, see steps
+        yield ("reset",)
+        yield ("wait_until_ready", timeout)
+        log.info("Resuming job at label %d of %d" % (self.printed + 1, len(self.images)))
+        return (yield from self.steps(ptouch, wait))
+
+    def image(self, i : int):
+        img = self.images[i]
+        return img if isinstance(img, Image.Image) else img.render()
+
+    def build_job(self, encoder : RasterEncoder, i : int):
+        last = i == len(self.images) - 1
+        if i == self.printed and self.offset:
+            log.info("Resuming label %d at raster line %d" % (i + 1, self.offset))
+            img = self.image(i)
+            return encoder.build_job(img.crop((self.offset, 0, img.width, img.height)), self.compress, last)
+        if self.jobs is None:
+            return encoder.build_job(self.image(i), self.compress, last)
+
+        while self.taken <= i:
+            self.encoded[self.taken] = next(self.jobs)
+            self.taken += 1
+        job, stats = self.encoded[i]
+        return set_last(job, last), stats
+
+    def wait(self, ptouch : PTD600):
+        # Give up when no label is reported printed for too long, a status block may have been lost
+        printed = self.printed
+        deadline = time.monotonic() + ptouch.PRINT_TIMEOUT / 1000
+        while not self.done:
+            yield from self.poll(ptouch.STATUS_TIMEOUT)
+            if self.printed > printed:
+                printed = self.printed
+                deadline = time.monotonic() + ptouch.PRINT_TIMEOUT / 1000
+            elif time.monotonic() > deadline:
+                self.check((yield ("getstatus",)))
+                raise self.timeout()
+
+    def poll(self, timeout : int):
+        # Handle status blocks until none arrives within timeout
+        while True:
+            status = yield ("read_status", timeout)
+            if status is None:
+                return
+            self.update(status)
+
+    def update(self, status):
+        if status.status_type == STATUS_PHASE and status.phase_type == PHASE_PRINTING:
+            if self.started is None:
+                self.started = time.monotonic()
+        elif status.status_type == STATUS_PRINTED:
+            self.encoded.pop(self.printed, None)
+            self.printed += 1
+            self.offset = 0
+            # the next label follows right away
+            self.started = time.monotonic()
+        elif status.status_type in (STATUS_ERROR, STATUS_OFF):
+            self.fail(status)
+        elif status.status_type == STATUS_NOTIFICATION:
+            log.info("Notification: %s" % status.notif_name)
+
+    def check(self, status):
+        # After a failed transfer or timeout, a printer fault means the job can be resumed
+        if status.error:
+            self.fail(status)
+
+    def timeout(self):
+        return Exception("Timeout waiting for PTD600 to print label %d of %d" % (self.printed + 1, len(self.images)))
+
+    def fail(self, status):
+        if self.started is not None and not self.done:
+            lines = int((time.monotonic() - self.started) * LINES_PER_SECOND)
+            self.offset = self.safe_offset(self.image(self.printed), self.offset, lines)
+        self.started = None
+        self.error = PrinterError(status)
+        log.warning("Printer error after %d of %d labels: %s" % (self.printed, len(self.images), self.error))
+        raise self.error
+
+    def safe_offset(self, img : Image.Image, start : int, lines : int):
+        # Raster line to restart a long label from, given about how many lines were printed since start.
+        # Backs up to a blank column, so the restart does not split a character.
+        if img.width < LONG_LABEL:
+            return 0
+        target = min(start + lines - SAFETY_LINES, img.width - 1)
+        for x in range(target, start, -1):
+            if img.crop((x, 0, x + 1, img.height)).getextrema()[0] == 255:
+                return x
+        return max(start, target)
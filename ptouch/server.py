@@ -0,0 +1,224 @@
+import os
+import io
+import sys
+import json
+import queue
+import base64
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import ExitStack
+
+from PIL import Image
+
+from . import metrics
+from .ptd600 import PTD600, PrinterError
+from .resume import PrintJob, READY_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+SOCKET_PATH = os.environ.get("PTOUCH_SOCKET",
+                             os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "ptouch.sock"))
+
+
+def encode_img(img : Image.Image):
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def decode_img(data : str):
+    img = Image.open(io.BytesIO(base64.b64decode(data)))
+    return img.convert("1")
+
+
+class RequestError(Exception):
+    # The request cannot be done, the printer is fine
+    pass
+
+
+class Job:
+    def __init__(self, req : dict):
+        self.req = req
+        self.done = threading.Event()
+        self.result = None
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # One JSON request per line, one JSON reply per line
+        for line in self.rfile:
+            try:
+                job = Job(json.loads(line))
+            except ValueError as e:
+                self.reply({"ok": False, "error": "Bad request: %s" % e})
+                continue
+            if job.req.get("cmd") == "metrics":
+                # answered right away, without waiting for queued print jobs
+                self.reply({"ok": True, "metrics": metrics.snapshot(), "text": metrics.prometheus_text()})
+                continue
+            self.server.jobs.put(job)
+            job.done.wait()
+            self.reply(job.result)
+
+    def reply(self, resp : dict):
+        self.wfile.write(json.dumps(resp).encode() + b"\n")
+        self.wfile.flush()
+
+
+class PrintServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path : str = SOCKET_PATH, **kwargs):
+        if os.path.exists(path):
+            # only remove the socket left behind by a server that is gone
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise Exception("Print server already running on %s" % path)
+            finally:
+                probe.close()
+        super().__init__(path, Handler)
+        self.path = path
+        self.kwargs = kwargs
+        self.jobs = queue.Queue()
+        self.device = ExitStack()
+        self.ptouch = None
+        # print job stopped by a printer fault, until it is resumed
+        self.failed = None
+
+        self.worker = threading.Thread(target=self.run_jobs, daemon=True)
+        self.worker.start()
+
+    def server_close(self):
+        super().server_close()
+        self.close_device()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def open_device(self):
+        if self.ptouch is None:
+            log.info("Open PTouch...")
+            self.ptouch = self.device.enter_context(PTD600.open(**self.kwargs))
+            self.ptouch.log_info()
+        else:
+            # tape may have been changed since the last job
+            self.ptouch.getstatus()
+        return self.ptouch
+
+    def close_device(self):
+        self.ptouch = None
+        self.device.close()
+
+    def run_jobs(self):
+        # Jobs are handled FIFO, this thread is the only user of the device
+        while True:
+            job = self.jobs.get()
+            try:
+                job.result = self.run_job(job.req)
+            except RequestError as e:
+                log.warning("Bad request: %s" % e)
+                job.result = {"ok": False, "error": str(e)}
+            except Exception as e:
+                log.exception("Job failed")
+                job.result = {"ok": False, "error": str(e)}
+                # reopen the device for the next job
+                self.close_device()
+            job.done.set()
+
+    def run_job(self, req : dict):
+        # The request is checked before the device is used, a bad one does not reopen it
+        cmd = req.get("cmd")
+        if cmd not in ("status", "print", "resume"):
+            raise RequestError("Unknown command: %s" % cmd)
+        if cmd == "print":
+            try:
+                images = [decode_img(data) for data in req["images"]]
+            except Exception as e:
+                raise RequestError("Bad images: %s" % e)
+        if cmd == "resume" and self.failed is None:
+            raise RequestError("No failed job to resume")
+
+        ptouch = self.open_device()
+
+        if cmd == "status":
+            status = ptouch.status._asdict()
+            status["tape_px"] = ptouch.tape_px
+            return {"ok": True, "status": status}
+
+        elif cmd == "print":
+            for img in images:
+                if ptouch.tape_px != img.height:
+                    raise RequestError("Incorrect Tape Size")
+            log.info("Printing %d label(s)" % len(images))
+            return self.print_job(ptouch, PrintJob(images, compress=req.get("compress", True)))
+
+        else:
+            log.info("Resuming job at label %d" % (self.failed.printed + 1))
+            return self.print_job(ptouch, self.failed, resume=True, timeout=req.get("timeout") or READY_TIMEOUT)
+
+
+    def print_job(self, ptouch : PTD600, job : PrintJob, resume : bool = False, timeout : int = READY_TIMEOUT):
+        self.failed = None
+        with metrics.job("print") as report:
+            try:
+                stats = job.resume(ptouch, timeout) if resume else job.run(ptouch)
+            except PrinterError as e:
+                # keep the job, so the client can resume it once the fault is cleared
+                self.failed = job
+                return {"ok": False, "error": str(e), "printed": job.printed, "total": len(job.images)}
+        return {"ok": True, "stats": [st._asdict() for st in stats], "report": report.as_dict()}
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Serves the counters for Prometheus to scrape
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics: " + format % args)
+
+
+def serve_metrics(port : int, host : str = "127.0.0.1"):
+    # Only local scrapers by default, pass host to expose the metrics further
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-8s - %(message)s", stream=sys.stdout)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket", type=str, default=SOCKET_PATH)
+    parser.add_argument("-c", "--chunk-size", type=int, default=PTD600.CHUNK_SIZE)
+    parser.add_argument("-P", "--printer", type=str, metavar="SERIAL", help="serve the PTD600 with this serial number")
+    parser.add_argument("-m", "--metrics-port", type=int, help="serve Prometheus metrics over HTTP on this port")
+    parser.add_argument("--metrics-host", type=str, default="127.0.0.1",
+                        help="address to serve metrics on, default 127.0.0.1, 0.0.0.0 for all interfaces")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port, args.metrics_host)
+        log.info("Metrics on http://%s:%d/metrics" % (args.metrics_host, args.metrics_port))
+
+    with PrintServer(args.socket, chunk_size=args.chunk_size, serial=args.printer) as server:
+        log.info("Listening on %s" % args.socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
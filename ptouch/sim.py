@@ -0,0 +1,181 @@
+import struct
+import logging
+from contextlib import contextmanager
+
+import usb1
+from PIL import Image
+
+from . import packbits
+from .ptd600 import PTD600, tape_sizes, _invert, AUTO_CUT, NO_CHAIN, STATUS_REPLY, STATUS_PRINTED, STATUS_ERROR, STATUS_PHASE, \
+    PHASE_EDITING, PHASE_PRINTING
+
+log = logging.getLogger(__name__)
+
+
+class SimHandle:
+    # Stands in for usb1.USBDeviceHandle, decodes everything PTD600 sends
+
+    def __init__(self, media_width : int = 24, max_px : int = 128):
+        assert media_width in tape_sizes
+        self.media_width = media_width
+        self.max_px = max_px
+        self.error = 0
+        # page index at which to fail with fail_error, like running out of tape
+        self.fail_page = None
+        self.fail_error = 0x0001
+        # pages cut short by a failure
+        self.torn = []
+        self.replies = []
+        self.buf = bytearray()
+        self.pages = []
+        self.cuts = 0
+        self.write_calls = 0
+        self.bytes_written = 0
+        # stored settings, used until a job sends ESC i M, A and K
+        self.stored_modes = (0x40, 1, 0x00)
+        # pages printed since the last cut
+        self.uncut = 0
+        self.reset()
+
+    def reset(self):
+        self.compress = False
+        self.raster_mode = False
+        self.various_mode, self.cut_every, self.advanced_mode = self.stored_modes
+        self.lines = []
+
+    def bulkWrite(self, endpoint : int, data, timeout : int = 0):
+        assert endpoint == PTD600.SEND_EP
+        self.write_calls += 1
+        self.bytes_written += len(data)
+        self.buf += data
+        self.parse()
+        return len(data)
+
+    def bulkRead(self, endpoint : int, length : int, timeout : int = 0):
+        assert endpoint == PTD600.RECV_EP
+        if not self.replies:
+            raise usb1.USBErrorTimeout()
+        return self.replies.pop(0)[:length]
+
+    def clear_error(self):
+        # Like closing the cover or loading new tape
+        self.error = 0
+
+    def status_block(self, status_type : int, phase_type : int = PHASE_EDITING):
+        return struct.pack("BBBBBBHHBBBBBBBBBBHBBBBI",
+                           0x80, 0x20, ord("B"), ord("0"), 0x64, ord("0"), 0, self.error,
+                           self.media_width, 0x01, 0, 0, 0, 0, 0, 0,
+                           status_type, phase_type, 0, 0, 0, 0x01, 0x08, 0)
+
+    def parse(self):
+        buf = self.buf
+        i = 0
+        while i < len(buf):
+            n = self.parse_cmd(buf, i)
+            if n == 0:
+                # incomplete command, wait for more data
+                break
+            i += n
+        del buf[:i]
+
+    def parse_cmd(self, buf : bytearray, i : int):
+        cmd = buf[i]
+        if cmd == 0x00:
+            # invalidate
+            return 1
+        elif cmd == 0x1b:
+            if i + 1 >= len(buf):
+                return 0
+            if buf[i + 1] == 0x40:
+                # ESC @ = init
+                self.reset()
+                return 2
+            if buf[i + 1] != ord("i"):
+                return self.unknown(buf, i)
+            if i + 2 >= len(buf):
+                return 0
+            sub = buf[i + 2]
+            if sub == ord("S"):
+                self.replies.append(self.status_block(STATUS_REPLY))
+                return 3
+            lengths = {ord("R"): 1, ord("K"): 1, ord("M"): 1, ord("A"): 1, ord("d"): 2, ord("z"): 10}
+            if sub not in lengths:
+                return self.unknown(buf, i)
+            if i + 3 + lengths[sub] > len(buf):
+                return 0
+            if sub == ord("R"):
+                self.raster_mode = buf[i + 3] == 0x01
+            elif sub == ord("M"):
+                self.various_mode = buf[i + 3]
+            elif sub == ord("A"):
+                self.cut_every = max(buf[i + 3], 1)
+            elif sub == ord("K"):
+                self.advanced_mode = buf[i + 3]
+            return 3 + lengths[sub]
+        elif cmd == ord("M"):
+            if i + 1 >= len(buf):
+                return 0
+            self.compress = buf[i + 1] == 0x02
+            return 2
+        elif cmd == ord("G"):
+            if i + 3 > len(buf):
+                return 0
+            n = struct.unpack_from("<H", buf, i + 1)[0]
+            if i + 3 + n > len(buf):
+                return 0
+            data = bytes(buf[i + 3:i + 3 + n])
+            self.add_line(packbits.decode(data) if self.compress else data)
+            return 3 + n
+        elif cmd == ord("Z"):
+            self.add_line(bytes(self.max_px // 8))
+            return 1
+        elif cmd in (0x0c, 0x1a):
+            # 0C = print, 1A = print and cut
+            if self.error:
+                # data sent while in error is thrown away
+                self.lines = []
+                return 1
+            if self.fail_page is not None and len(self.pages) == self.fail_page:
+                self.fail_page = None
+                self.error = self.fail_error
+                self.torn.append(self.lines)
+                self.lines = []
+                self.replies.append(self.status_block(STATUS_ERROR))
+                return 1
+            self.replies.append(self.status_block(STATUS_PHASE, PHASE_PRINTING))
+            self.pages.append(self.lines)
+            self.lines = []
+            self.uncut += 1
+            # with chain printing the last label stays in the printer until the next job feeds it out
+            fed = cmd == 0x0c or self.advanced_mode & NO_CHAIN
+            if self.various_mode & AUTO_CUT and fed and self.uncut >= self.cut_every:
+                self.cuts += 1
+                self.uncut = 0
+            self.replies.append(self.status_block(STATUS_PRINTED))
+            return 1
+        return self.unknown(buf, i)
+
+    def unknown(self, buf : bytearray, i : int):
+        raise ValueError("Unknown command at %d: %s" % (i, bytes(buf[i:i + 8]).hex()))
+
+    def add_line(self, line : bytes):
+        assert self.raster_mode, "Raster line outside raster mode"
+        assert len(line) == self.max_px // 8, "Bad raster line length %d" % len(line)
+        self.lines.append(line)
+
+    def images(self):
+        # Decode each printed page back into a label image
+        tape_px, tape_offset = tape_sizes[self.media_width]
+        imgs = []
+        for lines in self.pages:
+            raster = b''.join(lines).translate(_invert)
+            col = Image.frombytes("1", (self.max_px, len(lines)), raster)
+            img = col.transpose(Image.TRANSPOSE)
+            imgs.append(img.crop((0, tape_offset, img.width, tape_offset + tape_px)))
+        return imgs
+
+
+@contextmanager
+def open_sim(media_width : int = 24, **kwargs):
+    # Same interface as PTD600.open, backed by a simulated printer
+    yield PTD600(SimHandle(media_width), **kwargs)
@@ -0,0 +1,111 @@
+import logging
+
+from PIL import Image
+
+from .label import Label, qr_best_mask
+from .metrics import timed
+from .ptd600 import RasterEncoder, job_stats
+
+log = logging.getLogger(__name__)
+
+# item_wizard's id and QR format
+ID_FORMAT = "{id:05d}"
+QR_FORMAT = "https://znnxs.com/item/{id:05d}"
+
+
+def parse_range(text : str):
+    # "100-199" or "100+50" (start and count) or a single number
+    if "+" in text:
+        start, count = text.split("+", 1)
+        return range(int(start), int(start) + int(count))
+    if "-" in text:
+        start, end = text.split("-", 1)
+        return range(int(start), int(end) + 1)
+    return range(int(text), int(text) + 1)
+
+
+class LabelTemplate:
+    # Labels sharing title and subtitle, only the id and QR code change.
+    # The title block is rendered and rasterized once, each label only encodes its id and QR columns.
+
+    def __init__(self, title : str, subtitle : str = "", qr_format : str = QR_FORMAT, id_format : str = ID_FORMAT,
+                 height : int = 128, title_ratio : float = 0.7):
+        self.qr_format = qr_format
+        self.id_format = id_format
+        self.label = Label(title, subtitle, "", "", height=height, title_ratio=title_ratio)
+        # QR codes of a run look alike, use the mask that suits the first one for all of them
+        self.qr_mask_pattern = None
+
+        title_size, subtitle_size = self.label.font_sizes()
+        self.title = self.label.title_img(title_size)
+        self.subtitle_size = subtitle_size
+        # the title block is the same for every id, see Label.layout
+        parts, self.block_w, total_w = self.label.layout(self.title, subtitle_size)
+        self.block = Image.new("1", (self.block_w, height), "white")
+        for part, x, y in parts:
+            self.block.paste(part, (x, y))
+
+        # encoded title block for each tape geometry
+        self.encoded = {}
+
+    def mask_pattern(self, qr : str):
+        if self.qr_mask_pattern is None:
+            self.qr_mask_pattern = qr_best_mask(qr, self.label.qr_error_correction)
+            self.label.qr_mask_pattern = self.qr_mask_pattern
+        return self.qr_mask_pattern
+
+    def fields(self, n : int):
+        return self.id_format.format(id=n) if self.id_format else "", self.qr_format.format(id=n) if self.qr_format else ""
+
+    def make_label(self, n : int):
+        # Equivalent stand-alone label, e.g. for the raster cache
+        id, qr = self.fields(n)
+        label = Label(self.label.title, self.label.subtitle, id, qr, height=self.label.height,
+                      title_ratio=self.label.base_title_ratio)
+        if qr:
+            label.qr_mask_pattern = self.mask_pattern(qr)
+        return label
+
+    @timed("render")
+    def variable_img(self, n : int):
+        # Columns right of the title block, with the id and QR code of item n
+        id, qr = self.fields(n)
+        if qr:
+            self.mask_pattern(qr)
+        self.label.update(id=id, qrdata=qr)
+        parts, block_w, total_w = self.label.layout(self.title, self.subtitle_size)
+
+        img = Image.new("1", (total_w - block_w, self.label.height), "white")
+        # the title and subtitle are already in the block
+        for part, x, y in parts[2 if self.label.subtitle else 1:]:
+            img.paste(part, (x - block_w, y))
+        return img
+
+    def render(self, n : int):
+        var = self.variable_img(n)
+        img = Image.new("1", (self.block_w + var.width, self.label.height), "white")
+        img.paste(self.block, (0, 0))
+        img.paste(var, (self.block_w, 0))
+        return img
+
+    def encoded_block(self, encoder : RasterEncoder, compress : bool):
+        key = (encoder.tape_px, encoder.tape_offset, encoder.max_px, compress)
+        if key not in self.encoded:
+            cmds, stats = encoder.encode_raster(self.block, compress)
+            self.encoded[key] = (b''.join(cmds), stats)
+        return self.encoded[key]
+
+    def build_job(self, encoder : RasterEncoder, n : int, compress : bool = True, last : bool = True):
+        # Same job as encoder.build_job(make_label(n).render()), without redoing the title block
+        block, block_stats = self.encoded_block(encoder, compress)
+        cmds, stats = encoder.encode_raster(self.variable_img(n), compress)
+        stats = job_stats(*(a + b for a, b in zip(block_stats, stats)))
+
+        job = encoder.job_header(compress, last) + block + b''.join(cmds) + (b'\x1a' if last else b'\x0c')
+        return job, stats
+
+    def build_jobs(self, encoder : RasterEncoder, ids, compress : bool = True):
+        # Yields (job, stats) for a numbered run, only the last label ends with a cut
+        ids = list(ids)
+        for i, n in enumerate(ids):
+            yield self.build_job(encoder, n, compress, last=(i == len(ids) - 1))